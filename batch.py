@@ -0,0 +1,102 @@
+# -----------------------------------------------------------
+# Author: Daniel Jiang (danieldj@umich.edu)
+# This file is part of the Seat Adjustment System (SAS) project.
+# -----------------------------------------------------------
+
+# %% standard lib imports
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse, json, os, sys, time
+
+# %% first party imports
+from job import Job, Manifest, findProjects, getStageCacheDir
+from utils import readConfigFile
+
+
+def processProject(projectPath, outputPath, config, cacheDir=None):
+    """
+    processProject runs the Job of a project (in a worker process) and returns its entry of the report
+    """
+    tic = time.perf_counter()
+    job = None
+    try:
+        job = Job(projectPath, outputPath, config, cacheDir)
+        job.start()
+        result = {"project": projectPath, "status": "done", "output": job.getResultPath()}
+    except Exception as e:
+        result = {"project": projectPath, "status": "failed", "error": f"{type(e).__name__}: {e}"}
+    result["time"] = time.perf_counter() - tic
+    # the input files hashed by the job, for the manifest
+    result["inputs"] = job.inputs if job is not None else None
+    return result
+
+
+def processProjects(projectPaths, outputPath, config, workers=None, manifest=None, cacheDir=None):
+    """
+    processProjects runs the Jobs of the projects on a process pool (workers=None uses all cores) and returns
+    the report entries in the order the projects finish. Each result is recorded in the manifest (if given) as
+    soon as it is available. The outputs of the stages are cached in cacheDir (None disables the cache).
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(processProject, projectPath, outputPath, config, cacheDir) for projectPath in projectPaths]
+        for i, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            inputs = result.pop("inputs")
+            results.append(result)
+            if manifest is not None:
+                manifest.record(result["project"], config, result["status"], result.get("output"), result["time"], result.get("error"), inputs)
+            print(f"[{i}/{len(futures)}] {result['status']}: {result['project']} ({result['time']:0.1f} seconds)")
+    return results
+
+
+def printSummary(results, wallTime):
+    done = [result for result in results if result["status"] == "done"]
+    failed = [result for result in results if result["status"] != "done"]
+    processTime = sum(result["time"] for result in results)
+
+    print(f"Processed {len(done)} projects, {len(failed)} failed")
+    print(f"Total time: {wallTime:0.1f} seconds (process time: {processTime:0.1f} seconds)")
+    if results:
+        print(f"Average process time: {processTime / len(results):0.1f} seconds")
+    for result in failed:
+        print(f"Failed: {result['project']}: {result['error']}")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Process all the projects of a folder without the GUI")
+    argparser.add_argument('inputPath', help='Folder with the projects (folders with scan_0.ply and joints_0.csv)')
+    argparser.add_argument('outputPath', nargs='?', help='Folder of the processed meshes (default: inputPath)')
+    argparser.add_argument('-c', '--config', default=os.path.join('config', 'default_config.json'), help='Config file')
+    argparser.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes (default: all cores)')
+    argparser.add_argument('-r', '--report', help='Report file (default: outputPath/batch_report.json)')
+    argparser.add_argument('-f', '--force', action='store_true', help='Process the projects again even if they are unchanged')
+    argparser.add_argument('--no-stage-cache', action='store_true', help='Do not cache the output of each processing stage')
+    args = argparser.parse_args()
+
+    outputPath = args.outputPath or args.inputPath
+    config = readConfigFile(args.config)
+    if not config:
+        sys.exit(1)
+
+    projectPaths = findProjects(args.inputPath)
+    print(f"Found {len(projectPaths)} projects in {args.inputPath}")
+
+    # skip the projects processed before with the same inputs and parameters (see Manifest)
+    manifest = Manifest(outputPath)
+    if not args.force:
+        numProjects = len(projectPaths)
+        projectPaths = [projectPath for projectPath in projectPaths if not manifest.isProcessed(projectPath, config, ("done", "saved"))]
+        print(f"Skipping {numProjects - len(projectPaths)} projects already processed")
+
+    tic = time.perf_counter()
+    cacheDir = None if args.no_stage_cache else getStageCacheDir(outputPath)
+    results = processProjects(projectPaths, outputPath, config, args.workers, manifest, cacheDir)
+    wallTime = time.perf_counter() - tic
+    printSummary(results, wallTime)
+
+    reportPath = args.report or os.path.join(outputPath, 'batch_report.json')
+    with open(reportPath, "w") as outfile:
+        outfile.write(json.dumps({"config": config, "wallTime": wallTime, "projects": results}, indent=4))
+    print(f"Report: {reportPath}")
+
+    sys.exit(1 if any(result["status"] != "done" for result in results) else 0)
@@ -28,6 +28,10 @@ from PyQt5.QtWidgets import (
 
 
 class Configurator(QVBoxLayout):
+
+    # emitted whenever a config value changes (e.g., a slider is moved)
+    configChanged = pyqtSignal()
+
     def __init__(self, defaultConfigFilepath: str=None, *args, **kargs):
         super(QVBoxLayout, self).__init__(*args, **kargs)
 
@@ -109,6 +113,7 @@ class Configurator(QVBoxLayout):
         self._updateConfigUI()
         self.pushButton_resetAll.show()
         self.pushButton_exportConfig.show()
+        self.configChanged.emit()
 
     def _updateConfigUI(self):
         """
@@ -144,6 +149,7 @@ class Configurator(QVBoxLayout):
 
             slider.doubleValueChanged.connect(spinbox.setValue)
             spinbox.valueChanged.connect(slider.setValue)
+            spinbox.valueChanged.connect(self.configChanged)
             # self.pushButton_resetAll.clicked.connect(resetButton.click)
             self.configElements[key] = (label, slider, spinbox, resetButton)
 
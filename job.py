@@ -1,12 +1,163 @@
-import os, pymeshlab, glob
+import os, pymeshlab, glob, hashlib, json, time
+import numpy as np
 import pandas as pd
 
+# number of faces of the decimated previews displayed while the viewer is being interacted with
+PREVIEW_FACE_NUM = 100000
+
+def findProjects(inputPath):
+    # walk through the input folder and return the folders with a scan 'scan_0.ply' and joints 'joints_0.csv'
+    projectPaths = []
+    for subdir, dirs, files in os.walk(inputPath):
+        scanPath = os.path.join(subdir, 'scan_0.ply')
+        jointPath = os.path.join(subdir, 'joints_0.csv')
+        if (os.path.isfile(scanPath) and os.path.isfile(jointPath)):
+            projectPaths.append(subdir)
+    return projectPaths
+
+def getPreviewPath(resultPath):
+    # the preview of a result is cached in the .cache folder next to it
+    folder, filename = os.path.split(resultPath)
+    return os.path.join(folder, '.cache', filename)
+
+def exportPreview(ms, resultPath):
+    # decimate the current mesh (quadric edge collapse) and save it as the preview of the result.
+    # the current mesh is modified, so the result has to be saved first
+    previewPath = getPreviewPath(resultPath)
+    if ms.current_mesh().face_number() <= PREVIEW_FACE_NUM:
+        # small enough to be displayed as is
+        if os.path.isfile(previewPath):
+            os.remove(previewPath)
+        return
+    os.makedirs(os.path.dirname(previewPath), exist_ok=True)
+    ms.meshing_decimation_quadric_edge_collapse(targetfacenum=PREVIEW_FACE_NUM, preservenormal=True)
+    ms.save_current_mesh(previewPath)
+
+def getStageCacheDir(outputPath):
+    # the outputs of the stages of the Jobs are cached in the .cache folder of the output folder (see Job.start)
+    return os.path.join(outputPath, '.cache', 'stages')
+
+def getParameters(config):
+    # the values of the predictors used by a Job (the ranges of the sliders do not change the result)
+    return {key: val[1] for key, val in config['predictors'].items()}
+
+def getInputFiles(projectPath):
+    return sorted(glob.glob(os.path.join(projectPath, "scan_*.ply")) + glob.glob(os.path.join(projectPath, "joints_*.csv")))
+
+def _hashFile(filepath, chunkSize=1 << 24):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def getInputs(projectPath, previous=None):
+    # size, mtime and sha256 of the input files of a project, by file name.
+    # the hashes of previous (optional) are reused for the files whose size and mtime did not change
+    previous = previous or {}
+    inputs = {}
+    for filepath in getInputFiles(projectPath):
+        stat = os.stat(filepath)
+        name = os.path.basename(filepath)
+        entry = previous.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': _hashFile(filepath)}
+        inputs[name] = entry
+    return inputs
+
+def nearestDistance(points, targets, maxDist=np.inf, chunkSize=1 << 13):
+    # distance from each point to its closest target (inf for the points farther than maxDist from the bounding box of the targets).
+    # the targets are the few joint points of a scan, so they are compared one by one against cache-sized chunks of points
+    targets = np.asarray(targets, dtype=np.float64)
+    cols = np.asarray(points, dtype=np.float64).T
+    dist = np.full(cols.shape[1], np.inf)
+    near = np.flatnonzero(np.all((cols >= targets.min(axis=0)[:, None] - maxDist) & (cols <= targets.max(axis=0)[:, None] + maxDist), axis=0))
+    d, t = np.empty(chunkSize), np.empty(chunkSize)
+    for i in range(0, len(near), chunkSize):
+        idx = near[i:i + chunkSize]
+        x, y, z = cols[:, idx]
+        best = np.full(len(idx), np.inf)
+        dd, tt = d[:len(idx)], t[:len(idx)]
+        for tx, ty, tz in targets:
+            np.subtract(x, tx, out=dd)
+            np.multiply(dd, dd, out=dd)
+            np.subtract(y, ty, out=tt)
+            np.multiply(tt, tt, out=tt)
+            np.add(dd, tt, out=dd)
+            np.subtract(z, tz, out=tt)
+            np.multiply(tt, tt, out=tt)
+            np.add(dd, tt, out=dd)
+            np.minimum(best, dd, out=best)
+        dist[idx] = np.sqrt(best)
+    return dist
+
+class Manifest():
+    # The manifest of an output folder records the processed projects, one JSON line per record: the project, its
+    # input files (size, mtime and sha256), the parameters, the output path, the status and the process time.
+    # The file is only appended to (the last record of a project wins), so an interrupted run can be resumed.
+    filename = 'manifest.jsonl'
+
+    def __init__(self, outputPath):
+        self.path = os.path.join(outputPath, self.filename)
+        self.records = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # e.g. the last line of an interrupted run
+                        continue
+                    self.records[record['project']] = record
+
+    def getRecord(self, projectPath):
+        return self.records.get(os.path.abspath(projectPath))
+
+    def getInputs(self, projectPath):
+        # the hashes of the previous record are reused for the files whose size and mtime did not change
+        record = self.getRecord(projectPath)
+        return getInputs(projectPath, record['inputs'] if record is not None else {})
+
+    def isProcessed(self, projectPath, config, statuses=('done',)):
+        # True if the last record of the project has one of the statuses and the same parameters and input files
+        record = self.getRecord(projectPath)
+        if record is None or record['status'] not in statuses or record['parameters'] != getParameters(config):
+            return False
+        # a result deleted by the operator is not expected to exist
+        if record['status'] != 'deleted' and not (record['output'] and os.path.isfile(record['output'])):
+            return False
+        inputs = self.getInputs(projectPath)
+        return {name: entry['sha256'] for name, entry in inputs.items()} == {name: entry['sha256'] for name, entry in record['inputs'].items()}
+
+    def record(self, projectPath, config, status, output=None, processTime=None, error=None, inputs=None):
+        # inputs: the inputs the job used (see Job.get_inputs); by default the input files are hashed here
+        record = {
+            'project': os.path.abspath(projectPath),
+            'inputs': inputs if inputs is not None else self.getInputs(projectPath),
+            'parameters': getParameters(config),
+            'output': output,
+            'status': status,
+            'time': processTime,
+            'error': error,
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records[record['project']] = record
+
 class Job():
-    def __init__(self, subdir, outputPath, config):
+    def __init__(self, subdir, outputPath, config, cacheDir=None):
         self.config = config['predictors']
         self.subdir = subdir
         basename = os.path.basename(os.path.normpath(subdir)) # extract last directory name
         self.outputPath = os.path.join(outputPath, basename + '_processed.ply')
+        # the output of each stage is cached in cacheDir by a key of its inputs and parameters (see get_stage_keys);
+        # None disables the cache
+        self.cacheDir = cacheDir
+        # size, mtime and sha256 of the input files, see get_inputs
+        self.inputs = None
 
     def load_joint_points(self):
         # get filepaths for each of the joint file
@@ -22,7 +173,7 @@ class Job():
         # create a new MeshSet
         self.ms = pymeshlab.MeshSet()
         # load meshes
-        filepaths = glob.glob(os.path.join(self.subdir, "scan_*.ply"))
+        filepaths = sorted(glob.glob(os.path.join(self.subdir, "scan_*.ply")))
         for filepath in filepaths:
             self.ms.load_new_mesh(filepath)
         # flatten visible layers - combine all meshes
@@ -31,34 +182,31 @@ class Job():
 
     def remove_background(self, joint_arr):
         # get a reference to the current mesh
-        # store the scan mesh id and number of vertices for the hausdorff function
         m = self.ms.current_mesh()
-        scan_mesh_id = self.ms.current_mesh_id()
-        sample_num = m.vertex_number()
         print(f'Total vertices: {m.vertex_number()}')
 
-        # create a new mesh with the joint points
-        m = pymeshlab.Mesh(vertex_matrix = joint_arr)
-        self.ms.add_mesh(m)
-        joint_mesh_id = self.ms.current_mesh_id()
-
-        # set current mesh back to the scan mesh
-        self.ms.set_current_mesh(scan_mesh_id)
-        m = self.ms.current_mesh()
-        # Hausdorff Distance filter will store into the "quality" for each vertex of A the distance from the closest vertex of B;
-        # then use the conditional selection filter by testing against quality to remove background vertices.
-        self.ms.hausdorff_distance(sampledmesh=scan_mesh_id, targetmesh=joint_mesh_id, samplenum=sample_num, maxdist=pymeshlab.AbsoluteValue(self.config['radius'][1]))
-        self.ms.conditional_vertex_selection(condselect=f"(q >= {self.config['radius'][1]})")
+        # store the distance from each vertex to its closest joint point in a custom attribute;
+        # then use the conditional selection filter by testing against it to remove background vertices.
+        m.add_vertex_custom_scalar_attribute(nearestDistance(m.vertex_matrix(), joint_arr, self.config['radius'][1]), 'jointdist')
+        self.ms.conditional_vertex_selection(condselect=f"(jointdist >= {self.config['radius'][1]})")
         self.ms.delete_selected_vertices()
         print(f'Keeping {m.vertex_number()} vertices')
 
     def apply_filters(self):
+        self.compute_normals()
+        self.reconstruct_surface()
+        self.trim_faces()
+
+    def compute_normals(self):
         # compute normals for the points. use smooth iteration number 2.
         smoothiter = int(self.config['smoothiter'][1])
         self.ms.compute_normals_for_point_sets(smoothiter=smoothiter)
+
+    def reconstruct_surface(self):
         # reconstruct points as a surface using the Poisson method. use default parameters for now.
         self.ms.surface_reconstruction_screened_poisson()
 
+    def trim_faces(self):
         # print out default value for 'select_faces_with_edges_longer_than' function
         default_params = self.ms.filter_parameter_values('select_faces_with_edges_longer_than')
         print(f"Default threshold: {default_params['threshold']}")
@@ -71,9 +219,101 @@ class Job():
     def export_mesh(self):
         # save mesh
         self.ms.save_current_mesh(self.outputPath)
+        # save the decimated preview for the viewer
+        exportPreview(self.ms, self.outputPath)
         self.ms.clear()
         print("Saved!")
 
+    def get_inputs(self):
+        # the input files are hashed once per job (on the thread or process that runs it); the hashes are used by
+        # the stage keys and recorded in the manifest
+        if self.inputs is None:
+            self.inputs = getInputs(self.subdir)
+        return self.inputs
+
+    def get_stage_keys(self):
+        # content-addressed keys of the outputs of the stages: each key is a hash of the previous key, the stage,
+        # its inputs and its parameters, so a changed parameter only invalidates its stage and the following ones
+        inputs = sorted(self.get_inputs().items())
+        scans = [entry['sha256'] for name, entry in inputs if name.startswith('scan_')]
+        joints = [entry['sha256'] for name, entry in inputs if name.startswith('joints_')]
+        stages = (
+            ("merged", scans),
+            ("background", [joints, float(self.config['radius'][1])]),
+            ("normals", int(self.config['smoothiter'][1])),
+            ("surface", None),
+            ("trimmed", float(self.config['edgeLength'][1])),
+        )
+        keys = []
+        key = ''
+        for stage, parameters in stages:
+            key = hashlib.sha256(json.dumps([key, stage, parameters]).encode()).hexdigest()
+            keys.append(key)
+        return keys
+
+    def get_stage_path(self, key):
+        return os.path.join(self.cacheDir, key + '.ply')
+
+    def save_stage(self, key):
+        # write to a temporary file first, so that an interrupted save is not taken for a cached stage
+        os.makedirs(self.cacheDir, exist_ok=True)
+        tempPath = os.path.join(self.cacheDir, f"{key}.{os.getpid()}.tmp.ply")
+        self.ms.save_current_mesh(tempPath)
+        os.replace(tempPath, self.get_stage_path(key))
+
+    def prune_stages(self, keys):
+        # only the last completed chain of stages of a project is kept: remove the stages of the previous chain
+        # that it superseded (e.g. the trimmed mesh of a previous edgeLength)
+        indexPath = os.path.join(self.cacheDir, os.path.basename(self.outputPath) + '.json')
+        try:
+            with open(indexPath) as f:
+                previousKeys = json.load(f)
+        except (OSError, ValueError):
+            previousKeys = []
+        for key in set(previousKeys) - set(keys):
+            if os.path.isfile(self.get_stage_path(key)):
+                os.remove(self.get_stage_path(key))
+        tempPath = f"{indexPath}.{os.getpid()}.tmp"
+        with open(tempPath, 'w') as f:
+            json.dump(keys, f)
+        os.replace(tempPath, indexPath)
+
+    def start(self, progress=None):
+        # progress (optional) is called with the name of each stage before it starts
+        progress = progress or (lambda stage: None)
+        self.get_inputs()
+        stages = (
+            # create a mesh set with a single mesh that has been flattened
+            ("Loading", self.load_meshes),
+            # remove background vertices
+            ("Removing background", lambda: self.remove_background(self.load_joint_points())),
+            # apply filters
+            ("Computing normals", self.compute_normals),
+            ("Reconstructing surface", self.reconstruct_surface),
+            ("Trimming", self.trim_faces),
+        )
+
+        # resume after the last stage whose output is cached
+        keys = self.get_stage_keys() if self.cacheDir is not None else []
+        numCached = next((i + 1 for i in reversed(range(len(keys))) if os.path.isfile(self.get_stage_path(keys[i]))), 0)
+        if numCached:
+            cachedNames = ("merged scan", "background-removed cloud", "normals", "Poisson surface", "trimmed mesh")
+            progress(f"Loading cached {cachedNames[numCached - 1]}")
+            self.ms = pymeshlab.MeshSet()
+            self.ms.load_new_mesh(self.get_stage_path(keys[numCached - 1]))
+
+        for i, (stage, run) in enumerate(stages[numCached:], numCached):
+            progress(stage)
+            run()
+            if keys:
+                self.save_stage(keys[i])
+
+        # save mesh
+        progress("Saving")
+        self.export_mesh()
+        if keys:
+            self.prune_stages(keys)
+
     def getResultPath(self):
         return self.outputPath
 
@@ -97,6 +337,8 @@ class MergeJob:
         # save mesh
         print(self.outputPath)
         self.ms.save_current_mesh(self.outputPath)
+        # save the decimated preview for the viewer
+        exportPreview(self.ms, self.outputPath)
         self.ms.clear()
         print("Saved!")
 
@@ -4,8 +4,13 @@
 
 # %% standard lib imports
 from collections import defaultdict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import nullcontext
 from typing import Union
-import argparse, fileinput, re
+import argparse, hashlib, json, os, re, shutil, tempfile
+
+# %% third party imports
+import numpy as np
 
 # %% first party imports
 from utils_kparser import *
@@ -14,6 +19,7 @@ from utils_kparser import *
 # KLine Class
 class KLine:
     ''' Lexer for the parser
+    Used for keyword lines and PART lines. NODE and ELEMENT blocks are decoded in bulk (see decodeCards)
     Reference: https://supunsetunga.medium.com/writing-a-parser-getting-started-44ba70bb6cc9
 
     Attributes:
@@ -107,138 +113,137 @@ class KLine:
 
 
 #===================================================================================================
-# Dyna Model Definition
-class DynaModel:
-    ''' Parser for reading LS-DYNA k files
+# KFile Class
+class KFile:
+    ''' Reader for a single k file
+
+    The data is kept in compact arrays (no Node/Element/Part objects) and merged into the DynaModel
+    afterwards. NODE and ELEMENT blocks are split into line-aligned chunks that can be decoded in worker
+    processes; the chunks are read back from the file by the workers, so only the results are transferred.
+
+    Attributes:
+        filename: str
+        fileInd: int - index of the file in DynaModel.filepaths
+        blocks: list of (KEYWORD_TYPE, data) in the order they appear in the file
+            NODE: (nids, coords, lineNums)
+            ELEMENT: (elementType, name, eids, pids, nodeIds, lineNums). nodeIds is an (n, numNodes) array (0 if blank)
+            PART: (pid, header, (secid, mid, eosid, hgid, grav, adpopt, tmid), (first line number, last line number))
     '''
 
-    # Spacing/Separator for printing (default to CSV format). Can be updated to match the input file
-    nodesSeparator = ", "
-    elementsSeparator = ", "
-    partsSeparator = ", "
+    # Size of the chunks (in bytes) NODE and ELEMENT blocks are split into
+    chunkSize = 1 << 24
 
-    def __init__(self, args: Union[list[str],  str]) -> None:
-        ''' Initialize DynaModel
+    def __init__(self, filename: str, fileInd: int=0, executor: Executor=None, useMmap: bool=True, read: bool=True) -> None:
+        ''' Initialize KFile and read the file
 
-        nodesDict: dict[int, Node] - dictionary of nodes with node id as key.
-                   Value can be None if not defined in the k file but referenced in the element
-        elementDict: dict[int, Element] - dictionary of elements with element id as key.
-        partsDict: dict[int, Part] - dictionary of parts with part id as key.
+        executor: if given, the NODE and ELEMENT chunks are decoded on the executor. Call getBlocks()
+                  to wait for the results
+        useMmap: memory-map the file and scan it as bytes instead of reading it into memory
+        read: if False, the file is not read (used by the workers to decode a single chunk)
         '''
+        self.filename = filename
+        self.fileInd = fileInd
+        self.useMmap = useMmap
+        self.blocks = []
 
-        # NOTE: in the future, we should use a local database (such as SQLite) to store the data for better performance
-        self.nodesDict = defaultdict(Node)
-        self.elementDict = defaultdict(Element)
-        self.partsDict = defaultdict(Part)
+        # True if the blocks were loaded from a KFileCache
+        self.cached = False
 
-        # Ls-dyna allows duplicated element IDs, as long as they are in different element types (e.g. beam, shell, solid, etc.).
-        # e.g., an element_solid and element_shell might have the same eid
-        self._negEid = -1
+        if read:
+            self.__readFile(executor)
 
-        self.filepaths = []
-        if is_list_of_strings(args):
-            self.filepaths = args
-            for fileInd, filename in enumerate(args):
-                self.__readFile(filename, fileInd)
-        elif isinstance(args, str):
-            self.filepaths = [args]
-            self.__readFile(args)
-        else:
-            eprint("unknown argument: ", args)
-            return
 
-        print("Finished Reading kfiles!")
-        print(f"Total nodes: {len(self.nodesDict)}")
-        print(f"Total elements: {len(self.elementDict)}")
-        print(f"Total parts: {len(self.partsDict)}")
+    def __readFile(self, executor: Executor=None) -> None:
+        ''' Read a k file
 
+        The keyword lines are located first. The data lines between a keyword line and the next one
+        (a block) are then handed to the keyword's handler in one piece (or in chunks for NODE and ELEMENT).
+        '''
+        with openKFileData(self.filename, self.useMmap) as data, memoryview(data) as view:
+            self.__readBlocks(data, view, executor)
 
-    def __readFile(self, filename: str, fileInd: int=0) -> None:
-        ''' Read a k file
+
+    def __readBlocks(self, data, view: memoryview, executor: Executor=None) -> None:
+        ''' Locate the keyword lines and parse the blocks between them
         '''
+        keywordLines = list(scanKeywordLines(data))
 
-        # Keyword mode
-        currKeywordLine = KLine()
-        partList = []
+        for i, (lineNum, lineStart, lineEnd) in enumerate(keywordLines):
+            keywordText = view[lineStart:lineEnd].tobytes().decode()
+            kline = KLine(keywordText, lineNum=lineNum, fileInd=self.fileInd)
 
-        with open(filename, "rt") as reader:
-            # Read the entire file line by line
-            for i, line in enumerate(reader):
-                kline = KLine(line, currKeywordLine.keyword, i, fileInd)
+            # Skip unknown keywords
+            if not kline.isValid or kline.keyword not in self._modesDict:
+                continue
 
-                # Skip comment or empty line
-                if not kline.isValid:
-                    continue
+            # The block ends at the next keyword line (or at the end of the file)
+            blockEnd = keywordLines[i+1][1] if i+1 < len(keywordLines) else len(data)
+            blockStart = min(lineEnd+1, blockEnd)
 
-                # Keyword line
-                elif kline.isKeyword:
-                    # Execute part
-                    # NOTE: PART has multiple lines of data, therefore we record all the lines and
-                    # process them at the end of the section
-                    if currKeywordLine.keyword is KEYWORD_TYPE.PART:
-                        self._modesDict[currKeywordLine.keyword](self, partList, currKeywordLine)
-                        partList.clear()
+            if kline.keyword not in (KEYWORD_TYPE.NODE, KEYWORD_TYPE.ELEMENT):
+                self.readBlock(kline, view[blockStart:blockEnd], lineNum+1)
+                continue
 
-                    # Update mode
-                    currKeywordLine = kline
+            # Line number of the first line of each chunk
+            firstLineNum = lineNum + 1
+            for chunkStart, chunkEnd in splitLines(data, blockStart, blockEnd, self.chunkSize):
+                if executor is None:
+                    self.readBlock(kline, view[chunkStart:chunkEnd], firstLineNum)
+                else:
+                    self.blocks.append(executor.submit(_readChunk, self.filename, self.fileInd, keywordText, lineNum, chunkStart, chunkEnd, firstLineNum, self.useMmap))
+                firstLineNum += countNewlines(data, chunkStart, chunkEnd)
 
-                # Data line
-                elif kline.keyword in self._modesDict:
-                    # if keyword is PART, Add kline to partlist
-                    if kline.keyword is KEYWORD_TYPE.PART:
-                        # if the current line is a part header, execute the previous part
-                        if kline.isPartHeader and len(partList) > 0:
-                            self._modesDict[kline.keyword](self, partList, currKeywordLine)
-                            partList = [kline]
-                        else:
-                            partList.append(kline)
 
-                    # Execute line
-                    else:
-                        self._modesDict[kline.keyword](self, kline, currKeywordLine)
+    def readBlock(self, kline: KLine, data: memoryview, firstLineNum: int) -> None:
+        ''' Parse the data lines of a keyword (or a chunk of them)
+        '''
+        self._modesDict[kline.keyword](self, data, firstLineNum, kline)
 
 
-    def __NODE__(self, kline: KLine, currKeywordLine: KLine) -> None:
-        ''' Parse NODE line
+    def getBlocks(self) -> list:
+        ''' Return the parsed blocks, waiting for the chunks decoded on the executor
         '''
+        blocks = []
+        for block in self.blocks:
+            if isinstance(block, Future):
+                blocks.extend(block.result())
+            else:
+                blocks.append(block)
+        self.blocks = blocks
+        return blocks
 
-        # NOTE: might not need to use and try and except block since make3d will check for this
-        try:
-            if len(kline.values) == 1: # Fixed-length format
-                if currKeywordLine.I10: # 10 characters per field
-                    kline.values = splitString(kline.values[0], [10, 20, 20, 20, 10, 10], [True, True, True, True, False, False])
-                else: # 8 characters per field
-                    kline.values = splitString(kline.values[0], [8, 16, 16, 16, 8, 8], [True, True, True, True, False, False])
-
-            elif len(kline.values) < 4: # nid, x, y, z
-                eprint(f"Invalid {kline.keyword.name}: too less arguments; args: {kline.values}")
-                return
 
-            nid = int(kline.values[0])
-            coord = (float(kline.values[1]), float(kline.values[2]), float(kline.values[3]))
-        except ValueError:
-            # Check if the types of id and pos are correct
-            eprint(f"Invalid {kline.keyword.name}: bad type; args: {kline.values}")
-            return
+    def __NODE__(self, data: memoryview, firstLineNum: int, currKeywordLine: KLine) -> None:
+        ''' Parse a block of NODE lines
+        '''
 
-        # Check if id already exists
-        if nid in self.nodesDict:
-            node = self.nodesDict[nid]
-            if node.source is not None:
-                eprint(f"Invalid {kline.keyword.name}: Repeated node; id: {nid}, coord: {coord}")
-                return
+        # Fixed-length format: nid, x, y, z (tc and rc are not read)
+        if currKeywordLine.I10: # 10 characters per field
+            widths = [10, 20, 20, 20]
+        else: # 8 characters per field
+            widths = [8, 16, 16, 16]
+
+        fields, lineNums = decodeCards(data, widths, firstLineNum)
+        nids, badNids = parseNumbers(fields[0], np.int64)
+        coords, badCoords = zip(*[parseNumbers(field, np.float64) for field in fields[1:]])
+
+        # Check if the number of arguments and the types of id and pos are correct
+        missing = np.any([field == b'' for field in fields], axis=0)
+        bad = missing | badNids | np.any(badCoords, axis=0)
+        for i in np.flatnonzero(bad):
+            args = [field[i].decode() for field in fields if field[i]]
+            if missing[i]:
+                eprint(f"Invalid {currKeywordLine.keyword.name}: too less arguments; args: {args}")
             else:
-                # Update node
-                # NOTE: by specifying _coord and _source, we are updating the node quietly (without marking modified)
-                self.nodesDict[nid]._coord = coord
-                self.nodesDict[nid]._source = (kline.fileInd, kline.lineNum)
-        else:
-            # Add node to dictionary
-            self.nodesDict[nid] = Node(nid, coord, (kline.fileInd, kline.lineNum))
+                eprint(f"Invalid {currKeywordLine.keyword.name}: bad type; args: {args}")
+
+        # NOTE: repeated nodes are checked when the nodes are merged into the DynaModel
+        good = ~bad
+        self.blocks.append((KEYWORD_TYPE.NODE, (nids[good], np.column_stack(coords)[good], lineNums[good])))
 
 
-    def __ELEMENT__(self, kline: KLine, currKeywordLine: KLine) -> None:
-        ''' Parse ELEMENT line
+    def __ELEMENT__(self, data: memoryview, firstLineNum: int, currKeywordLine: KLine) -> None:
+        ''' Parse a block of ELEMENT lines
         '''
 
         # Element type specific settings
@@ -246,7 +251,6 @@ class DynaModel:
         numNodes = 0
         if elementType == ELEMENT_TYPE.UNKNOWN:
             # Disregard unknown element type
-            # eprint(f"Invalid {kline.keyword.name}: unknown element type; args: {kline.values}")
             return
         elif elementType == ELEMENT_TYPE.BEAM:
             numNodes = 3
@@ -266,83 +270,57 @@ class DynaModel:
         *ELEMENT_SHELL
         880880238800011488159065881792458817920788179207
         '''
-        try:
-            if len(kline.values) == 1: # Fixed-length format
-                if currKeywordLine.I10: # 10 characters per field
-                    length = 10
-                else: # 8 characters per field
-                    length = 8
-
-                groupLengths = [length] * (2 + numNodes)
-                # Enforce group lengths. If the element type is shell, the last 4 groups are not enforced
-                enforcedGroups = [True] * (2 + numNodes) if elementType != ELEMENT_TYPE.SHELL else [True] * 6 + [False] * 4
-                kline.values = splitString(kline.values[0], groupLengths, enforcedGroups)
-
-            if not kline.values:
-                eprint(f"Invalid {kline.keyword.name}_{currKeywordLine.keywordSubtype}: {kline.lineNum} {numNodes}")
-                return
-
-            eid = int(kline.values[0])
-            pid = int(kline.values[1])
-
-            nodes = []
-            for nid in kline.values[2:2+numNodes]:
-                if not nid:
-                    continue
-
-                nid = int(nid)
-
-                # 0 is an invalid node id
-                if nid == 0:
-                    continue
-
-                if nid not in self.nodesDict:
-                    # Add node to dictionary
-                    self.nodesDict[nid] = Node(nid=nid)
-                nodes.append(self.nodesDict[nid])
-
-            if len(nodes) != numNodes and (elementType == ELEMENT_TYPE.SHELL and len(nodes) != 4):
-                eprint(f"Invalid {kline.keyword.name}_{currKeywordLine.keywordSubtype}: expected {numNodes} nodes, received {len(nodes)} nodes; args (eid, pid, nid1, nid2...): {kline.values}")
-                return
+        length = 10 if currKeywordLine.I10 else 8
+        fields, lineNums = decodeCards(data, [length] * (2 + numNodes), firstLineNum)
+        name = f"{currKeywordLine.keyword.name}_{currKeywordLine.keywordSubtype}"
+
+        eids, badEids = parseNumbers(fields[0], np.int64)
+        pids, badPids = parseNumbers(fields[1], np.int64)
+        nodeIds, badNodeIds = zip(*[parseNumbers(field, np.int64) for field in fields[2:]])
+        # (n, numNodes) array of node ids. 0 is an invalid node id (or a blank field)
+        nodeIds = np.column_stack(nodeIds)
+
+        # Check if the types are correct
+        bad = (fields[0] == b'') | (fields[1] == b'') | badEids | badPids | np.any(badNodeIds, axis=0)
+        for i in np.flatnonzero(bad):
+            eprint(f"Invalid {name}: bad type; args: {[field[i].decode() for field in fields if field[i]]}")
+
+        # Shells can have either 4 or 8 nodes
+        numValidNodes = np.count_nonzero(nodeIds, axis=1)
+        if elementType == ELEMENT_TYPE.SHELL:
+            wrongCount = ~bad & (numValidNodes != 4) & (numValidNodes != numNodes)
+            for i in np.flatnonzero(wrongCount):
+                eprint(f"Invalid {name}: expected {numNodes} nodes, received {numValidNodes[i]} nodes; args (eid, pid, nid1, nid2...): {[field[i].decode() for field in fields if field[i]]}")
+            bad |= wrongCount
+
+        good = ~bad
+        self.blocks.append((KEYWORD_TYPE.ELEMENT, (elementType, name, eids[good], pids[good], nodeIds[good], lineNums[good])))
+
+
+    def __PART__(self, data: memoryview, firstLineNum: int, currKeywordLine: KLine) -> None:
+        ''' Parse a block of PART lines
+        NOTE: PART has multiple lines of data and a block can hold several parts. Each part starts with a
+        header line, therefore we record all the lines of a part and process them together
+        '''
+        partList = []
+        for i, line in enumerate(data.tobytes().decode().split('\n')):
+            kline = KLine(line, currKeywordLine.keyword, firstLineNum + i, currKeywordLine.fileInd)
 
-        except ValueError:
-            # Check if the types are correct
-            eprint(f"Invalid {kline.keyword.name}_{currKeywordLine.keywordSubtype}: bad type; args: {kline.values}")
-            return
+            # Skip comment or empty line
+            if not kline.isValid:
+                continue
 
-        # This is a repeated element with the same id and type!
-        if eid in self.elementDict:
-            if self.elementDict[eid].type == elementType:
-                eprint(f"Repeated element: eid: {eid}, pid: {pid}, elementType: {elementType}")
-                return
+            # if the current line is a part header, execute the previous part
+            if kline.isPartHeader and len(partList) > 0:
+                self.__readPart(partList)
+                partList = [kline]
             else:
-                newElement = Element(eid=self._negEid, nodes=nodes, type=elementType, source=(kline.fileInd, kline.lineNum), priorEid=eid)
-                self.elementDict[self._negEid] = newElement
-                self._negEid -= 1
-        else:
-            newElement = Element(eid=eid, nodes=nodes, type=elementType, source=(kline.fileInd, kline.lineNum), priorEid=eid)
-            self.elementDict[eid] = newElement
+                partList.append(kline)
 
-        # Check if Part exists and Part's element type matches (each Part can only have one type of elements)
-        if pid not in self.partsDict:
-            # Specify element type
-            newPart = Part(pid=pid, elementType=elementType)
-            self.partsDict[pid] = newPart
-
-        else:
-            # Check if element type matches
-            if len(self.partsDict[pid].elements) == 0:
-                self.partsDict[pid]._elementType = elementType
-
-            elif self.partsDict[pid].elementType != elementType:
-                eprint(f"Invalid {kline.keyword.name}_{currKeywordLine.keywordSubtype}: Part's element type mismatch; pid: {pid}, Part's element type: {self.partsDict[pid]._elementType}, element type: {elementType}")
-                return
-
-        # Add element to Part
-        self.partsDict[pid].elements.add(newElement)
+        self.__readPart(partList)
 
 
-    def __PART__(self, klineList: list[KLine], keywordSubtype: str) -> None:
+    def __readPart(self, klineList: list[KLine]) -> None:
         ''' NOTE: Only reading the basic information of Part
         '''
 
@@ -360,8 +338,473 @@ class DynaModel:
             return
 
         vals = [int(i) for i in klineList[1].values] + [0] * (8 - len(klineList[1].values))
-        pid, secid, mid, eosid, hgid, grav, adpopt, tmid = vals
+        pid = vals[0]
+        self.blocks.append((KEYWORD_TYPE.PART, (pid, header, tuple(vals[1:8]), (klineList[0].lineNum, klineList[-1].lineNum))))
+
+
+    def __KEYWORD__(self, data: memoryview, firstLineNum: int, currKeywordLine: KLine):
+        pass
+
+
+    def __END__(self, data: memoryview, firstLineNum: int, currKeywordLine: KLine):
+        pass
+
+
+    _modesDict = {
+        KEYWORD_TYPE.ELEMENT: __ELEMENT__,
+        KEYWORD_TYPE.END: __END__,
+        KEYWORD_TYPE.KEYWORD: __KEYWORD__,
+        KEYWORD_TYPE.NODE: __NODE__,
+        KEYWORD_TYPE.PART: __PART__,
+    }
+
+
+def _readChunk(filename: str, fileInd: int, keywordText: str, keywordLineNum: int, start: int, end: int, firstLineNum: int, useMmap: bool=True) -> list:
+    ''' Decode the chunk [start, end) of a keyword block in a worker process. Return the parsed blocks
+    '''
+    kfile = KFile(filename, fileInd, useMmap=useMmap, read=False)
+    kline = KLine(keywordText, lineNum=keywordLineNum, fileInd=fileInd)
+
+    if useMmap:
+        with openKFileData(filename) as data, memoryview(data) as view:
+            kfile.readBlock(kline, view[start:end], firstLineNum)
+    else:
+        with open(filename, "rb") as reader:
+            reader.seek(start)
+            kfile.readBlock(kline, memoryview(reader.read(end - start)), firstLineNum)
+
+    return kfile.blocks
+
+
+#===================================================================================================
+# KFile Cache
+class KFileCache:
+    ''' On-disk cache of parsed k files
+
+    Each k file is stored as an uncompressed .npz file (named after the file's absolute path) holding the
+    arrays of its blocks and a JSON description of the blocks. An entry is used if the k file's size and
+    modification time are unchanged, or if only the modification time changed but the content hash did not.
+    '''
+
+    # Increment when the layout of the blocks changes
+    version = 1
+
+    def __init__(self, cacheDir: str) -> None:
+        self.cacheDir = cacheDir
+        os.makedirs(cacheDir, exist_ok=True)
+
+
+    def __cachePath(self, filename: str) -> str:
+        filename = os.path.abspath(filename)
+        key = hashlib.sha1(filename.encode()).hexdigest()[:16]
+        return os.path.join(self.cacheDir, f"{os.path.basename(filename)}.{key}.npz")
+
+
+    def load(self, filename: str, fileInd: int=0) -> KFile:
+        ''' Return the cached KFile, or None if the file is not cached or has changed
+        '''
+        cachePath = self.__cachePath(filename)
+        if not os.path.isfile(cachePath):
+            return None
+
+        try:
+            with np.load(cachePath) as arrays:
+                meta = json.loads(str(arrays["meta"]))
+                if meta["version"] != self.version or meta["path"] != os.path.abspath(filename):
+                    return None
+
+                stat = os.stat(filename)
+                if stat.st_size != meta["size"]:
+                    return None
+
+                # The file might have been touched or copied without changing its content
+                if stat.st_mtime_ns != meta["mtime"]:
+                    if hashFile(filename) != meta["hash"]:
+                        return None
+
+                kfile = KFile(filename, fileInd, read=False)
+                kfile.blocks = self.__unpackBlocks(meta["blocks"], arrays)
+                kfile.cached = True
+
+        except (OSError, ValueError, KeyError) as e:
+            eprint(f"Invalid cache file: {cachePath}; {e}")
+            return None
+
+        # Refresh the modification time, so that the file is not hashed again next time
+        if stat.st_mtime_ns != meta["mtime"]:
+            self.save(kfile)
+
+        return kfile
+
+
+    def save(self, kfile: KFile) -> None:
+        ''' Store a parsed KFile in the cache
+        '''
+        stat = os.stat(kfile.filename)
+        blocks, arrays = self.__packBlocks(kfile.getBlocks())
+        meta = {
+            "version": self.version,
+            "path": os.path.abspath(kfile.filename),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": hashFile(kfile.filename),
+            "blocks": blocks,
+        }
+
+        # Write to a unique temporary file first, so that an interrupted write never leaves a broken entry
+        # (and concurrent writers of the same entry do not write to the same file)
+        cachePath = self.__cachePath(kfile.filename)
+        tempname = None
+        try:
+            with tempfile.NamedTemporaryFile("wb", dir=self.cacheDir, suffix=".tmp.npz", delete=False) as writer:
+                tempname = writer.name
+                np.savez(writer, meta=np.array(json.dumps(meta)), **arrays)
+            # readable by the other users of the cache, as the files created by open
+            setDefaultFileMode(tempname)
+            os.replace(tempname, cachePath)
+        except BaseException:
+            if tempname is not None and os.path.exists(tempname):
+                os.remove(tempname)
+            raise
+
+
+    def __packBlocks(self, blocks: list) -> tuple[list, dict[str, np.ndarray]]:
+        ''' Split the blocks into a JSON-serializable description and a dictionary of arrays
+        '''
+        description = []
+        arrays = {}
+        for i, (keyword, block) in enumerate(blocks):
+            if keyword is KEYWORD_TYPE.NODE:
+                nids, coords, lineNums = block
+                arrays.update({f"{i}_nids": nids, f"{i}_coords": coords, f"{i}_lineNums": lineNums})
+                description.append([keyword.name])
+            elif keyword is KEYWORD_TYPE.ELEMENT:
+                elementType, name, eids, pids, nodeIds, lineNums = block
+                arrays.update({f"{i}_eids": eids, f"{i}_pids": pids, f"{i}_nodeIds": nodeIds, f"{i}_lineNums": lineNums})
+                description.append([keyword.name, elementType.name, name])
+            elif keyword is KEYWORD_TYPE.PART:
+                pid, header, vals, lineNums = block
+                description.append([keyword.name, pid, header, list(vals), list(lineNums)])
+        return description, arrays
+
+
+    def __unpackBlocks(self, description: list, arrays) -> list:
+        ''' Rebuild the blocks from the description and the arrays written by __packBlocks
+        '''
+        blocks = []
+        for i, (keyword, *args) in enumerate(description):
+            keyword = KEYWORD_TYPE[keyword]
+            if keyword is KEYWORD_TYPE.NODE:
+                blocks.append((keyword, (arrays[f"{i}_nids"], arrays[f"{i}_coords"], arrays[f"{i}_lineNums"])))
+            elif keyword is KEYWORD_TYPE.ELEMENT:
+                elementType, name = args
+                blocks.append((keyword, (ELEMENT_TYPE[elementType], name, arrays[f"{i}_eids"], arrays[f"{i}_pids"], arrays[f"{i}_nodeIds"], arrays[f"{i}_lineNums"])))
+            elif keyword is KEYWORD_TYPE.PART:
+                pid, header, vals, lineNums = args
+                blocks.append((keyword, (pid, header, tuple(vals), tuple(lineNums))))
+        return blocks
+
+
+#===================================================================================================
+# KFile Writer
+class KFileWriter:
+    ''' Writer that saves the modified cards of a k file
+
+    Only the modified lines are formatted; the unchanged byte ranges between them are copied in large chunks
+    (with os.sendfile where possible). The file is written to a temporary file next to it and renamed over the
+    original, so the original is left untouched if writing fails. Each card keeps the format of the line it
+    replaces (fixed-width, I10 or free format), and the number of lines does not change, so the sources of
+    the nodes, elements and parts stay valid.
+
+    Attributes:
+        filename: str
+        useMmap: bool
+    '''
+
+    # Unchanged ranges of at least this many bytes are copied by the kernel (os.sendfile)
+    sendfileSize = 1 << 20
+
+    def __init__(self, filename: str, useMmap: bool=True) -> None:
+        self.filename = filename
+        self.useMmap = useMmap
+
+
+    def write(self, patches: list[tuple]) -> None:
+        ''' Write the patches to the file
+
+        patches: list of (first line number, last line number (inclusive), Node/Element/Part, pid), sorted by
+                 line number. pid is the part id written for an element (None for its own pid)
+        '''
+        if not patches:
+            return
+
+        lineNums = np.array([[first, last + 1] for first, last, *_ in patches], dtype=np.int64)
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        tempname = None
+        try:
+            with open(self.filename, "rb") as reader, openKFileData(self.filename, self.useMmap) as data, memoryview(data) as view:
+                offsets = lineOffsets(data, lineNums.ravel()).reshape(-1, 2)
+                with tempfile.NamedTemporaryFile("wb", dir=directory, suffix=".k.tmp", delete=False) as writer:
+                    tempname = writer.name
+                    pos = 0
+                    keyword = KLine()
+                    for (start, end), (_, _, obj, pid) in zip(offsets.tolist(), patches):
+                        if start < pos:
+                            eprint(f"Overlapping modified lines in {self.filename}; skipping {obj}")
+                            continue
+                        keyword = self.__findKeyword(data, pos, start, keyword)
+                        self.__copy(reader, writer, view, pos, start)
+                        lines = view[start:end].tobytes().decode().split('\n')
+                        writer.write('\n'.join(self.__formatLines(obj, pid, lines, keyword)).encode())
+                        pos = end
+                    self.__copy(reader, writer, view, pos, len(data))
+            shutil.copymode(self.filename, tempname)
+            os.replace(tempname, self.filename)
+        except BaseException:
+            if tempname is not None and os.path.exists(tempname):
+                os.remove(tempname)
+            raise
+
+
+    def __copy(self, reader, writer, view: memoryview, start: int, end: int) -> None:
+        ''' Copy the byte range [start, end) of the original file
+        '''
+        if end - start >= self.sendfileSize and hasattr(os, "sendfile"):
+            writer.flush()
+            while start < end:
+                sent = os.sendfile(writer.fileno(), reader.fileno(), start, end - start)
+                if sent == 0:
+                    break
+                start += sent
+        writer.write(view[start:end])
+
+
+    @staticmethod
+    def __findKeyword(data, start: int, end: int, keyword: KLine) -> KLine:
+        ''' Return the last keyword line before the offset end, given the keyword line before the offset start
+        A keyword line starts with '*' (leading whitespace is allowed, as in scanKeywordLines)
+        '''
+        pos = end
+        while True:
+            pos = data.rfind(b'*', start, pos)
+            if pos == -1:
+                return keyword
+            lineStart = data.rfind(b'\n', 0, pos) + 1
+            if lineStart >= start and not data[lineStart:pos].strip(b' \t'):
+                break
+            pos = lineStart
+        lineEnd = data.find(b'\n', pos)
+        return KLine(bytes(data[lineStart:lineEnd if lineEnd != -1 else len(data)]).decode())
+
+
+    @staticmethod
+    def __formatLines(obj, pid: int, lines: list[str], keyword: KLine) -> list[str]:
+        ''' Return the lines that replace the original lines of the object
+        '''
+        I10 = keyword.isValid and keyword.I10
+        if isinstance(obj, Node):
+            widths = [10, 20, 20, 20, 10, 10] if I10 else [8, 16, 16, 16, 8, 8]
+            return [formatCard([obj.nid, *obj.coord], lines[0], widths)] + lines[1:]
+
+        if isinstance(obj, Element):
+            values = [obj.priorEid, obj.pid if pid is None else pid] + [node.nid for node in obj.nodes]
+            return [formatCard(values, lines[0], [10 if I10 else 8] * len(values), keepTail=False)] + lines[1:]
+
+        if isinstance(obj, Part):
+            # The first line is the header; the next line that is not a comment holds the part data
+            lines = [obj.header] + lines[1:]
+            for i, line in enumerate(lines[1:], 1):
+                if line.strip() and not line.lstrip().startswith('$'):
+                    lines[i] = formatCard([obj.pid, obj.secid, obj.mid, obj.eosid, obj.hgid, obj.grav, obj.adpopt, obj.tmid], line, [10] * 8)
+                    break
+            return lines
+
+        eprint(f"Object type not recognized: {type(obj)}")
+        return lines
+
+
+#===================================================================================================
+# Dyna Model Definition
+class DynaModel:
+    ''' Parser for reading LS-DYNA k files
+    '''
+
+    # Spacing/Separator for printing (default to CSV format). Can be updated to match the input file
+    nodesSeparator = ", "
+    elementsSeparator = ", "
+    partsSeparator = ", "
+
+    def __init__(self, args: Union[list[str],  str], workers: int=1, useMmap: bool=True, cacheDir: str=None) -> None:
+        ''' Initialize DynaModel
+
+        args: k file path or list of k file paths
+        workers: number of worker processes used to decode the NODE and ELEMENT blocks.
+                 1 reads the files in this process; None uses all the cores
+        useMmap: memory-map the k files instead of reading them into memory (lower peak memory)
+        cacheDir: directory of the parsed k file cache (see KFileCache). Only the files that changed since
+                  they were cached are parsed. None disables the cache
+
+        nodeStore: NodeStore - columnar storage of all the nodes (sorted by node id).
+                   Nodes referenced by elements but not defined in the k files have no source.
+        elementStores: dict[ELEMENT_TYPE, ElementStore] - columnar storage of the elements of each type.
+        partsDict: dict[int, Part] - dictionary of parts with part id as key.
+        '''
+
+        # NOTE: in the future, we should use a local database (such as SQLite) to store the data for better performance
+        self.nodeStore = NodeStore()
+        self.elementStores = {}
+        self.partsDict = defaultdict(Part)
+
+        # Number of elements read so far (the order of the elements across element types)
+        self._numElementsRead = 0
+
+        # Sorted element ids and the (element type, row) of each element, see __finalizeElements
+        self._elementIds = np.empty(0, dtype=np.int64)
+        self._elementLocations = np.empty((0, 2), dtype=np.int64)
+
+        self.useMmap = useMmap
+        self.filepaths = []
+        if is_list_of_strings(args):
+            self.filepaths = args
+        elif isinstance(args, str):
+            self.filepaths = [args]
+        else:
+            eprint("unknown argument: ", args)
+            return
+
+        # Merge the files in order, so that repeated ids are resolved the same way regardless of workers
+        for kfile in self.__readFiles(workers, useMmap, cacheDir):
+            self.__loadKFile(kfile)
+
+        # Merge the parsed nodes and elements into the arrays
+        self.nodeStore.finalize()
+        self.__finalizeElements()
+
+        print("Finished Reading kfiles!")
+        print(f"Total nodes: {len(self.nodeStore)}")
+        print(f"Total elements: {self.numElements}")
+        print(f"Total parts: {len(self.partsDict)}")
+
+
+    def __readFiles(self, workers: int=1, useMmap: bool=True, cacheDir: str=None):
+        ''' Read the k files (or load them from the cache) and yield the KFiles in order
+
+        If workers is not 1, the NODE and ELEMENT blocks of all the files are split into chunks and
+        decoded on a process pool, so a single large file is also read in parallel
+        '''
+        if workers is None:
+            workers = os.cpu_count()
+
+        cache = KFileCache(cacheDir) if cacheDir is not None else None
+
+        def openKFile(fileInd: int, filename: str, executor: Executor=None) -> KFile:
+            kfile = cache.load(filename, fileInd) if cache is not None else None
+            return kfile if kfile is not None else KFile(filename, fileInd, executor, useMmap)
+
+        with (ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext()) as executor:
+            kfiles = (openKFile(fileInd, filename, executor) for fileInd, filename in enumerate(self.filepaths))
+
+            # With a pool, submit the chunks of every file first, then merge the files in order as they complete
+            if executor is not None:
+                kfiles = list(kfiles)
+
+            for kfile in kfiles:
+                kfile.getBlocks()
+                if cache is not None and not kfile.cached:
+                    cache.save(kfile)
+                yield kfile
+
+
+    def __loadKFile(self, kfile: KFile) -> None:
+        ''' Merge the data read from a k file into the model
+        '''
+        for keyword, block in kfile.getBlocks():
+            if keyword is KEYWORD_TYPE.NODE:
+                nids, coords, lineNums = block
+                # NOTE: repeated nodes are checked when the store is finalized
+                self.nodeStore.append(nids, coords, np.column_stack((np.full(len(nids), kfile.fileInd), lineNums)))
+            elif keyword is KEYWORD_TYPE.ELEMENT:
+                self.__addElements(kfile.fileInd, *block)
+            elif keyword is KEYWORD_TYPE.PART:
+                self.__addPart(kfile.fileInd, *block)
+
+
+    def __addElements(self, fileInd: int, elementType: ELEMENT_TYPE, name: str, eids: np.ndarray, pids: np.ndarray, nodeIds: np.ndarray, lineNums: np.ndarray) -> None:
+        ''' Add a block of elements of the same type. Repeated elements are resolved in __finalizeElements
+        '''
+
+        # The nodes might be defined later (or in another file); the store resolves them when finalized
+        self.nodeStore.reference(nodeIds[nodeIds != 0])
+
+        if elementType not in self.elementStores:
+            self.elementStores[elementType] = ElementStore(elementType, self.nodeStore)
+
+        sources = np.column_stack((np.full(len(eids), fileInd), lineNums))
+        order = np.arange(self._numElementsRead, self._numElementsRead + len(eids))
+        self.elementStores[elementType].append(eids, pids, nodeIds, sources, order)
+        self._numElementsRead += len(eids)
+
+
+    def __finalizeElements(self) -> None:
+        ''' Merge the parsed elements into the arrays and link them to the parts
+        '''
+        for store in self.elementStores.values():
+            store.finalize()
+
+        stores = list(self.elementStores.values())
+        if not stores:
+            return
+
+        storeInds = np.concatenate([np.full(len(store), i) for i, store in enumerate(stores)])
+        rows = np.concatenate([np.arange(len(store)) for store in stores])
+        eids = np.concatenate([store.priorEids for store in stores])
+        pids = np.concatenate([store.pids for store in stores])
+        order = np.concatenate([store.order for store in stores])
+
+        # Ls-dyna allows duplicated element IDs, as long as they are in different element types (e.g. beam, shell, solid, etc.).
+        # e.g., an element_solid and element_shell might have the same eid
+        # The element read first keeps its id; the others get negative ids (-1, -2, ...) in the order they were read
+        sortInd = np.lexsort((order, eids))
+        repeated = sortInd[1:][eids[sortInd[1:]] == eids[sortInd[:-1]]]
+        repeated = repeated[np.argsort(order[repeated])]
+        eids[repeated] = -1 - np.arange(len(repeated))
+        for i, store in enumerate(stores):
+            store.eids = eids[storeInds == i]
+
+        # Index of all the elements by id
+        sortInd = np.argsort(eids)
+        self._elementIds = eids[sortInd]
+        self._elementLocations = np.column_stack((storeInds, rows))[sortInd]
+
+        # The element type of a Part is the type of the first element read with its pid
+        sortInd = np.lexsort((order, pids))
+        first = sortInd[np.concatenate(([True], pids[sortInd[1:]] != pids[sortInd[:-1]]))]
+        partPids, partStores = pids[first], storeInds[first] # sorted by pid
+        partStoreInds = dict(zip(partPids.tolist(), partStores.tolist()))
+
+        for pid, i in partStoreInds.items():
+            # Check if Part exists (it might not be defined by a PART keyword)
+            if pid not in self.partsDict:
+                self.partsDict[pid] = Part(pid=pid, elementType=stores[i].elementType)
+            self.partsDict[pid]._elementType = stores[i].elementType
+            self.partsDict[pid]._elementStore = stores[i]
+
+        # Each Part can only have one type of elements
+        mismatch = np.flatnonzero(partStores[np.searchsorted(partPids, pids)] != storeInds)
+        for i in mismatch:
+            store = stores[storeInds[i]]
+            eprint(f"Invalid ELEMENT_{store.elementType.name}: Part's element type mismatch; pid: {pids[i]}, Part's element type: {stores[partStoreInds[pids[i]]].elementType}, element type: {store.elementType}")
+
+        for store in stores:
+            store.order = np.empty(0, dtype=np.int64)
+
+
+    def __addPart(self, fileInd: int, pid: int, header: str, vals: tuple, lineNums: tuple[int, int]) -> None:
+        ''' Add a part read from a k file
+        '''
+        secid, mid, eosid, hgid, grav, adpopt, tmid = vals
         identifiers = [pid, header]
+        source = (fileInd, *lineNums)
 
         if pid in self.partsDict:
             # Check duplicate Part
@@ -370,7 +813,7 @@ class DynaModel:
                 return
 
             # Update Part
-            self.partsDict[pid]._source = (klineList[0].fileInd, klineList[0].lineNum, klineList[-1].lineNum)
+            self.partsDict[pid]._source = source
 
             self.partsDict[pid]._header = header
             self.partsDict[pid]._secid = secid
@@ -386,103 +829,138 @@ class DynaModel:
                 self.partsDict[header] = self.partsDict[pid]
         else:
             # Add Part to dictionary
-            newPart = Part(pid=pid, source=(klineList[0].fileInd, klineList[0].lineNum, klineList[-1].lineNum), header=header, secid=secid, mid=mid, eosid=eosid, hgid=hgid, grav=grav, adpopt=adpopt, tmid=tmid)
+            newPart = Part(pid=pid, source=source, header=header, secid=secid, mid=mid, eosid=eosid, hgid=hgid, grav=grav, adpopt=adpopt, tmid=tmid)
             for identifier in identifiers:
                 self.partsDict[identifier] = newPart
 
 
-    def __KEYWORD__(self, kline: KLine):
-        pass
-
-
-    def __END__(self, kline: KLine):
-        pass
-
-
     def __createModifiedList(self):
-        ''' Create a list of the sources of modified nodes, elements and parts
+        ''' Create a list of the modified nodes, elements and parts of each file
+        Each list holds (first line number, last line number, Node/Element/Part, pid) sorted by line number
         '''
-        # Create a list of dictionaries
-        # NOTE: it is perhaps better to use a list of sorted lists
+        # Create a list of dictionaries (line number -> patch)
         modifiedLists = [{} for _ in range(len(self.filepaths))]
 
-        for node in self.nodesDict.values():
-            if node.modified:
-                modifiedLists[node.source[0]][node.source[1]] = (node.source[1], node)
+        # Only the dirty rows of the node store are visited
+        rows = np.flatnonzero(self.nodeStore.modified)
+        for node, (fileInd, lineNum) in zip(self.nodeStore.viewRows(rows), self.nodeStore.sources[rows].tolist()):
+            if fileInd < 0:
+                eprint(f"Modified node has no source; id: {node.nid}")
+                continue
+            modifiedLists[fileInd][lineNum] = (lineNum, lineNum, node, None)
 
-        for element in self.elementDict.values():
-            if element.modified:
-                modifiedLists[element.source[0]][element.source[1]] = (element.source[1], element, self.__findElementPartCorrespondences(element))
-                # modifiedElements.add(element)
+        for store in self.elementStores.values():
+            for row in np.flatnonzero(store.modified):
+                element = store.view(row)
+                fileInd, lineNum = element.source
+                part = self.getElementPart(element)
+                modifiedLists[fileInd][lineNum] = (lineNum, lineNum, element, part.pid if part is not None else None)
 
-        for part in self.partsDict.values():
+        for part in {id(part): part for part in self.partsDict.values()}.values():
             if part.modified:
-                modifiedLists[part.source[0]][part.source[1]] = (part.source[2], part)
-
-        return modifiedLists
-
-
-    def __findElementPartCorrespondences(self, element: Element):
-        ''' Find the parts that the element belongs to
-        '''
-        for part in self.partsDict.values():
-            if part.elementType != element.type:
-                continue
-
-            if element in part.elements:
-                return part.pid
+                if part.source is None:
+                    eprint(f"Modified part has no source; pid: {part.pid}")
+                    continue
+                fileInd, firstLine, lastLine = part.source
+                modifiedLists[fileInd][firstLine] = (firstLine, lastLine, part, None)
 
-        return None
-
-
-    _modesDict = {
-        KEYWORD_TYPE.ELEMENT: __ELEMENT__,
-        KEYWORD_TYPE.END: __END__,
-        KEYWORD_TYPE.KEYWORD: __KEYWORD__,
-        KEYWORD_TYPE.NODE: __NODE__,
-        KEYWORD_TYPE.PART: __PART__,
-    }
+        return [[modifiedList[lineNum] for lineNum in sorted(modifiedList)] for modifiedList in modifiedLists]
 
 
 #---------------------------------------------------------------------------------------------------
 # Public methods
 
     def getNode(self, nid: int) -> Node:
-        ''' Return the node's coordinates given its ID
+        ''' Return the node (a view into the node store) given its ID
         '''
-        if nid not in self.nodesDict:
-            eprint(f"Node id: {nid} not in nodesIndDict")
+        if nid not in self.nodeStore:
+            eprint(f"Node id: {nid} not in nodeStore")
             return None
-        return self.nodesDict[nid]
+        return self.nodeStore.view(nid)
 
 
     def getNodes(self, nids: list[int]=[]) -> list[Node]:
         ''' Return a list of nodes given a list of IDs
         '''
-        return [self.nodesDict[nid] for nid in nids]
+        return [self.getNode(nid) for nid in nids]
 
 
-    def getNodesCoord(self, nids: list[int]=[]) -> list[tuple[float, float, float]]:
-        ''' Return a list of nodes' coordinates given a list of IDs
+    def getNodesCoord(self, nids: Union[list[int], np.ndarray]=[]) -> np.ndarray:
+        ''' Return an (n, 3) array of the nodes' coordinates given a list of IDs
         '''
-        return [self.nodesDict[nid].coord() for nid in nids]
+        ind = self.nodeStore.indexOf(nids)
+        if np.any(ind < 0):
+            eprint(f"Node ids: {np.asarray(nids)[ind < 0]} not in nodeStore")
+            return None
+        return self.nodeStore.coords[ind]
 
 
-    def getAllNodesCoord(self) -> list[Node]:
-        return [node.getCoord() for node in self.nodesDict]
+    def getAllNodesCoord(self) -> np.ndarray:
+        ''' Return an (N, 3) array of all the nodes' coordinates (sorted by node id)
+        '''
+        return self.nodeStore.coords
+
+
+    def setNodeCoords(self, nids: Union[list[int], np.ndarray], coords: np.ndarray) -> bool:
+        ''' Set the coordinates of many nodes at once given their IDs and an (n, 3) array of coordinates
+        The nodes are marked as modified, so saveFile writes them. Return False (and change nothing) if an ID
+        is not in the model
+        '''
+        nids = np.asarray(nids, dtype=np.int64).ravel()
+        coords = np.asarray(coords, dtype=np.float64)
+        if coords.shape != (len(nids), 3):
+            raise ValueError(f"Expected an array of shape ({len(nids)}, 3) for the coordinates, received {coords.shape}")
+
+        ind = self.nodeStore.indexOf(nids)
+        if np.any(ind < 0):
+            eprint(f"Node ids: {nids[ind < 0]} not in nodeStore")
+            return False
+        self.nodeStore.setCoords(ind, coords)
+        return True
+
+
+    @property
+    def numElements(self) -> int:
+        ''' Return the number of elements of all types
+        '''
+        return len(self._elementIds)
 
 
     def getElement(self, eid: int) -> Element:
-        ''' Return the ELEMENT given its ID
+        ''' Return the ELEMENT (a view into its element store) given its ID
+        '''
+        ind = np.searchsorted(self._elementIds, eid)
+        if ind == len(self._elementIds) or self._elementIds[ind] != eid:
+            eprint(f"Element id: {eid} not in elementStores")
+            return None
+        storeInd, row = self._elementLocations[ind]
+        return list(self.elementStores.values())[storeInd].view(row)
+
+
+    def getElementPart(self, element: Union[int, Element]) -> Part:
+        ''' Return the PART that the element (or element ID) belongs to, None if it is not in any part
         '''
-        if eid not in self.elementDict:
-            eprint(f"Element id: {eid} not in elementShellDict")
+        if not isinstance(element, Element):
+            element = self.getElement(element)
+            if element is None:
+                return None
+
+        # The pid is recorded per element; an element whose type does not match its part's type is not in the part
+        part = self.partsDict.get(element.pid)
+        if part is None or part._elementStore is not element._store:
             return None
-        return self.elementDict[eid]
+        return part
+
+
+    def getAllElements(self) -> list[Element]:
+        ''' Return all the elements (views), sorted by ID
+        '''
+        stores = list(self.elementStores.values())
+        return [stores[storeInd].view(row) for storeInd, row in self._elementLocations.tolist()]
 
 
-    def getElementCoords(self, element: Union[int, Element]) -> list[tuple[float, float, float]]:
-        ''' Return a list of coordinates of the element's nodes given the element or eid
+    def getElementCoords(self, element: Union[int, Element]) -> np.ndarray:
+        ''' Return an (n, 3) array of coordinates of the element's nodes given the element or eid
         '''
         if isinstance(element, int):
             element = self.getElement(element)
@@ -490,7 +968,7 @@ class DynaModel:
         if not isinstance(element, Element):
             return None
 
-        return [node.coord() for node in element.nodes]
+        return self.getNodesCoord([node.nid for node in element.nodes])
 
 
     def getPart(self, pid: Union[int, str]) -> Part:
@@ -505,11 +983,11 @@ class DynaModel:
     def getPartData(self, pid: Union[int, str]):
         ''' Return the PART data given its ID
 
-            verts = list of coordinates of the corresponding element shells.
-                    e.g. [(x1,y1,z1),(x2,y2,z2),(x3,y3,z3),(x4,y4,z4),(x5,y5,z5),(x6,y6,z6)]
-            faces = indices of the corresponding nodes in verts (compatible with vedo's
-                    mesh constructor)
-                    e.g. [[n1_ind,n2_ind,n3_ind,n4_ind],[n4_ind,n5_ind,n6_ind]]
+            verts = (N, 3) array of the coordinates of the nodes of the part's elements.
+                    e.g. [[x1,y1,z1],[x2,y2,z2],[x3,y3,z3],[x4,y4,z4],[x5,y5,z5],[x6,y6,z6]]
+            faces = (M, k) array of the indices of the corresponding nodes in verts (compatible with vedo's
+                    mesh constructor); triangles among quads repeat their last node.
+                    e.g. [[n1_ind,n2_ind,n3_ind,n4_ind],[n4_ind,n5_ind,n6_ind,n6_ind]]
         '''
         if isinstance(pid, int) or isinstance(pid, str):
             part = self.getPart(pid)
@@ -521,55 +999,53 @@ class DynaModel:
 
 
     def getAllPartsData(self, verbose: bool=False):
-        # Create a set of the vertices that only appear in the part
-        verts = list({v.coord for part in self.partsDict.values() for element in part.elements for v in element.nodes})
-        elements = {element for part in self.partsDict.values() for element in part.elements}
+        ''' Return the data of all the parts (see getPartData) as one mesh
+        '''
+        parts = {id(part): part for part in self.partsDict.values() if part._elementStore is not None}.values()
 
-        if verbose:
-            print(f"Unreferenced nodes: {len(self.nodesDict) - len(verts)}")
-            print(f"Unreferenced elements: {len(self.elementDict) - len(elements)}")
+        # Elements of the parts; an element whose type does not match its part's type is not in any part
+        storeRows = []
+        for store in self.elementStores.values():
+            pids = [part.pid for part in parts if part._elementStore is store]
+            storeRows.append((store, np.flatnonzero(np.isin(store.pids, pids))))
 
-        # Create a mapping from the new vertex list to the new index
-        vert_map = dict(zip(verts, range(len(verts))))
+        # Only the skin of the solid parts is displayed; pad the faces to the same number of nodes by repeating the last node
+        surfaces = [store.surfaceIndices(rows) for store, rows in storeRows]
+        width = max((faces.shape[1] for faces in surfaces), default=0)
+        faceIndices = [padFaces(faces, width) for faces in surfaces]
+        verts, faces = buildMeshData(self.nodeStore, np.concatenate(faceIndices) if faceIndices else np.empty((0, 0), dtype=np.int64))
+
+        if verbose:
+            print(f"Unreferenced nodes: {len(self.nodeStore) - len(verts)}")
+            print(f"Faces: {len(faces)} (elements: {self.numElements})")
 
-        # Iterate over the reduced vertex list and update the face indices
-        faces = [[vert_map[v.coord] for v in element.nodes] for element in elements]
         return verts, faces
 
 
+    def getDisplayMeshes(self, generate: bool=False) -> list:
+        ''' Return the display meshes of all the parts, one actor per part (see Part.update_display_mesh)
+        The meshes share the vtkPoints of the NodeStore; use generate=True to create them
+        '''
+        parts = {id(part): part for part in self.partsDict.values() if part._elementStore is not None}.values()
+        meshes = [part.update_display_mesh(generate) for part in parts]
+        return [mesh for mesh in meshes if mesh is not None]
+
+
     def saveFile(self):
-        ''' Save the parsed file to a new file
+        ''' Save the modifications to the parsed files (in place)
         '''
         modifiedLists = self.__createModifiedList()
-        print(f"Modified list: {modifiedLists}")
+        print(f"Modified lines: {[len(modifiedList) for modifiedList in modifiedLists]}")
 
-        for i, modifiedList in enumerate(modifiedLists):
-            if len(modifiedList) == 0:
-                continue
+        for filepath, modifiedList in zip(self.filepaths, modifiedLists):
+            KFileWriter(filepath, self.useMmap).write(modifiedList)
 
-            prevEnd = -1
-
-            # The fileinput.input function is used to read the contents of the file and replace the lines in place.
-            # The inplace=True argument ensures that the changes are written back to the file.
-            with fileinput.input(self.filepaths[i], inplace=True) as file:
-                for lineNum, line in enumerate(file):
-                    if lineNum <= prevEnd:
-                        continue
-
-                    if lineNum in modifiedList:
-
-                        obj = modifiedList[lineNum][1]
-                        # NOTE: using default separator (CSV) for now. Plan to dynamically change this to match the input file in the future
-                        if isinstance(obj, Element):
-                            print(obj.toK(pid=modifiedList[lineNum][2], sep=', '), end='\n')
-                            prevEnd = modifiedList[lineNum][0]
-                        elif isinstance(obj, Node) or isinstance(obj, Part):
-                            print(obj.toK(sep=', '), end='\n')
-                            prevEnd = modifiedList[lineNum][0]
-                        else:
-                            eprint(f"Object type not recognized: {type(obj)}")
-                    else:
-                        print(line, end='')
+        # The modifications are saved; clear the modified flags
+        self.nodeStore.modified[:] = False
+        for store in self.elementStores.values():
+            store.modified[:] = False
+        for part in self.partsDict.values():
+            part.modified = False
 
 
 #===================================================================================================
@@ -4,7 +4,8 @@
 # -----------------------------------------------------------
 
 # %% standard lib imports
-import sys, time, os
+from concurrent.futures import ThreadPoolExecutor
+import sys, time, os, copy
 
 # %% first party imports
 from job import *
@@ -16,11 +17,12 @@ from k_parser import *
 # %% project-specific imports
 ## Qt
 from PyQt5.uic import loadUi
-from PyQt5.QtCore import pyqtSignal, QCoreApplication
+from PyQt5.QtCore import pyqtSignal, QCoreApplication, QObject, QRunnable, QThreadPool, QTimer
 from PyQt5.QtGui import QIcon, QFont
 from PyQt5.QtWidgets import (
     QMainWindow,
     QFileDialog,
+    QCheckBox,
     QListWidgetItem,
     QMessageBox,
     QApplication,
@@ -91,6 +93,10 @@ class MainWindow(QMainWindow):
         self.resultPath = "" # path to the most recent finished project ply file
         self.sumProcessTime = .0 # process time for each scan
         self.numProcessed = 0 # total number of processed scans
+        self.jobs = {} # project path -> config, status and result of its job (see requestJob)
+        self.manifest = None # processed projects of the output folder (see getProjectPaths)
+        self.currentProject = None # project whose result is waited for
+        self.threadPool = QThreadPool() # runs the jobs, so that the window does not freeze
 
         ''' Initialize the Configurator for SAS page'''
         self.configurator_SAS = Configurator(r'config/default_config.json')
@@ -120,12 +126,31 @@ class MainWindow(QMainWindow):
         self.pushButton_startRegression.setText(QCoreApplication.translate("MainWindow", "START"))
         self.pushButton_startRegression.setObjectName("pushButton_startRegression")
         self.pushButton_startRegression.clicked.connect(self.startRegression)
+        self.checkBox_liveRegression = QCheckBox("Live Preview", self.stackWidgetPanel_regression)
+        self.checkBox_liveRegression.setFont(font)
+        self.checkBox_liveRegression.setObjectName("checkBox_liveRegression")
+        self.checkBox_liveRegression.setToolTip('Update the displayed model while the predictors are changed')
+        self.verticalLayout_4.addWidget(self.checkBox_liveRegression)
         self.verticalLayout_4.addWidget(self.pushButton_startRegression)
         spacer = QSpacerItem(20, 20, hPolicy=QSizePolicy.Minimum, vPolicy=QSizePolicy.Expanding)
         self.verticalLayout_4.addItem(spacer)
 
         # initialize the regression model when start is pressed
         self.regression = None
+        # k files of the regression folder, read once; later predictions are patched into its nodes
+        self.regressionModel = None
+        # HERMES_main.k is written in the background (in order) while the prediction is displayed
+        self.regressionWriter = ThreadPoolExecutor(max_workers=1)
+        self.regressionWrite = None
+        # displayed meshes of the regression parts; they share the node coordinates of self.regressionModel
+        self.regressionMeshes = None
+
+        # live preview: slider changes are throttled and only move the vertices of the displayed mesh
+        self.regressionPreviewTimer = QTimer(self)
+        self.regressionPreviewTimer.setSingleShot(True)
+        self.regressionPreviewTimer.setInterval(30) # ms
+        self.regressionPreviewTimer.timeout.connect(self.updateRegressionPreview)
+        self.configurator_regression.configChanged.connect(self.regressionConfigChanged)
 
 
     def getfilePath(self, ):
@@ -197,14 +222,13 @@ class MainWindow(QMainWindow):
             self.panel_right.setMinimumWidth(0)
 
     def getProjectPaths(self):
-        # walk through the input folder
-        for subdir, dirs, files in os.walk(self.inputPath):
-            # search for scan with filename 'scan_*.ply'
-            scanPath = os.path.join(subdir, 'scan_0.ply')
-            jointPath = os.path.join(subdir, 'joints_0.csv')
-            if (os.path.isfile(scanPath) and os.path.isfile(jointPath)):
-                # add to projectPaths
-                self.projectPaths.append(subdir)
+        # walk through the input folder (see findProjects in job.py)
+        # skip the projects reviewed before with the same inputs and config (see Manifest in job.py)
+        self.manifest = Manifest(self.outputPath)
+        config = self.configurator_SAS.getConfig()
+        for projectPath in findProjects(self.inputPath):
+            if not self.manifest.isProcessed(projectPath, config, ("saved", "deleted")):
+                self.projectPaths.append(projectPath)
 
     def startProcessing(self):
         self.getProjectPaths()
@@ -215,39 +239,98 @@ class MainWindow(QMainWindow):
 
     def singleProcessing(self):
         if(self.indPath < len(self.projectPaths)):
-            tic = time.perf_counter()
             projectPath = self.projectPaths[self.indPath]
             config = self.configurator_SAS.getConfig()
             print(config)
 
-            self.resultPath = self.processProject(projectPath, config)
+            # the result is displayed by showResult as soon as the job is done (it may be done already)
+            self.currentProject = projectPath
+            self.requestJob(projectPath, config)
+            if self.jobs[projectPath]["status"] != "running":
+                self.showResult(projectPath)
+            else:
+                self.textBrowser_currentProject.setText(f"Processing {projectPath}")
+        else:
+            self.finishProcessing()
+
+    def requestJob(self, projectPath, config):
+        """
+        requestJob processes a project with the given config in the background, unless it is already processed
+        (or being processed) with the same config. A job that failed is started again
+        """
+        job = self.jobs.get(projectPath)
+        if job is not None and job["config"] == config and job["status"] in ("running", "done"):
+            return
+        if job is None and self.manifest.isProcessed(projectPath, config):
+            # processed by a previous run (e.g. interrupted before the result was reviewed)
+            record = self.manifest.getRecord(projectPath)
+            self.jobs[projectPath] = {"config": copy.deepcopy(config), "status": "done", "restart": False,
+                                      "resultPath": record["output"], "processTime": record["time"], "inputs": record["inputs"]}
+            return
+        if job is not None and job["status"] == "running":
+            # both jobs write the same file; start again once the running one is done
+            job["config"] = copy.deepcopy(config)
+            job["restart"] = True
+            return
+
+        self.jobs[projectPath] = {"config": copy.deepcopy(config), "status": "running", "restart": False}
+        worker = JobWorker(projectPath, self.outputPath, copy.deepcopy(config))
+        worker.signals.progress.connect(self.jobProgress)
+        worker.signals.finished.connect(self.jobFinished)
+        worker.signals.failed.connect(self.jobFailed)
+        self.threadPool.start(worker)
+
+    def jobProgress(self, projectPath, stage):
+        print(f"{stage}: {projectPath}")
+        if projectPath == self.currentProject:
+            self.textBrowser_currentProject.setText(f"{stage}: {projectPath}")
+
+    def jobFinished(self, projectPath, resultPath, processTime, inputs):
+        self.updateJob(projectPath, status="done", resultPath=resultPath, processTime=processTime, inputs=inputs)
+
+    def jobFailed(self, projectPath, error, processTime, inputs):
+        print(f"Failed: {projectPath}: {error}")
+        self.updateJob(projectPath, status="failed", error=error, processTime=processTime, inputs=inputs)
+
+    def updateJob(self, projectPath, **result):
+        job = self.jobs.get(projectPath)
+        if job is None:
+            # processing was finished or restarted in the meantime
+            return
+        if job["restart"]:
+            # the config changed while the job was running
+            del self.jobs[projectPath]
+            self.requestJob(projectPath, job["config"])
+            return
+        job.update(result)
+        self.manifest.record(projectPath, job["config"], job["status"], job.get("resultPath"), job["processTime"], job.get("error"), job["inputs"])
+        if projectPath == self.currentProject:
+            self.showResult(projectPath)
+
+    def showResult(self, projectPath):
+        """
+        showResult displays the result of the current project and processes the next project in the background while
+        the result is reviewed
+        """
+        job = self.jobs[projectPath]
+        self.currentProject = None
+        if job["status"] == "done":
+            self.resultPath = job["resultPath"]
             self.displayResult(self.resultPath)
             self.textBrowser_currentProject.setText(self.resultPath)
-
-            self.indPath = self.indPath + 1
-            self.pushButton_dontSave.setEnabled(True)
             self.pushButton_saveAndContinue.setEnabled(True)
-            self.pushButton_redo.setEnabled(True)
-
-            toc = time.perf_counter()
-            self.computeProcessTIme(tic, toc)
         else:
-            self.finishProcessing()
+            self.resultPath = ""
+            self.textBrowser_currentProject.setText(f"Failed: {projectPath}: {job['error']}")
+
+        self.indPath = self.indPath + 1
+        self.pushButton_dontSave.setEnabled(True)
+        self.pushButton_redo.setEnabled(True)
+        self.addProcessTime(job["processTime"])
 
-    def processProject(self, projectPath, config):
-        job = Job(projectPath, self.outputPath, config)
-        # load joint points to a numpy array
-        joint_arr = job.load_joint_points()
-        # create a mesh set with a single mesh that has been flattened
-        job.load_meshes()
-        # remove background vertices
-        job.remove_background(joint_arr)
-        # apply filters
-        job.apply_filters()
-        # save mesh
-        job.export_mesh()
-        #get result path
-        return job.getResultPath()
+        # speculatively process the next project with the current config
+        if self.indPath < len(self.projectPaths):
+            self.requestJob(self.projectPaths[self.indPath], self.configurator_SAS.getConfig())
 
     def displayResult(self, filename):
         if (not filename.lower().endswith(('.ply', '.obj', '.stl'))):
@@ -256,15 +339,52 @@ class MainWindow(QMainWindow):
         fileBaseName = os.path.basename(filename)
         m = Mesh(filename)
         m.name = fileBaseName
-        self.display(m)
+        self.display(m, self.loadPreview(filename, m))
 
-    def display(self, m):
+    def loadPreview(self, filename, m):
+        """
+        loadPreview returns the decimated preview of a result mesh (None if the mesh is small enough).
+        The preview saved by the job is used if it is up to date; otherwise it is built and cached.
+        """
+        if m.ncells <= PREVIEW_FACE_NUM:
+            return None
+
+        previewPath = getPreviewPath(filename)
+        if os.path.isfile(previewPath) and os.path.getmtime(previewPath) >= os.path.getmtime(filename):
+            preview = Mesh(previewPath)
+        else:
+            preview = m.clone().decimate(fraction=PREVIEW_FACE_NUM / m.ncells)
+            os.makedirs(os.path.dirname(previewPath), exist_ok=True)
+            preview.write(previewPath)
+        preview.name = m.name
+        return preview
+
+    def display(self, m, preview=None):
+        """
+        display shows m; if a (decimated) preview is given, it is displayed instead while the view is being
+        rotated, panned or zoomed, and m is displayed again when idle
+        """
+        # the regression meshes are no longer displayed
+        self.regressionMeshes = None
         self.plt.clear()
-        self.plt.show(m, zoom=True)                 # <--- show the vedo rendering
+        if preview is None:
+            self.plt.show(m, zoom=True)                 # <--- show the vedo rendering
+            return
+
+        preview.off()
+        self.plt.show(m, preview, zoom=True)
+        # vedo sets a new interactor style on show; observe the current one
+        style = self.plt.interactor.GetInteractorStyle()
+        style.AddObserver("StartInteractionEvent", lambda obj, event: self.switchLevelOfDetail(m, preview))
+        style.AddObserver("EndInteractionEvent", lambda obj, event: self.switchLevelOfDetail(preview, m))
+
+    def switchLevelOfDetail(self, hide, show):
+        hide.off()
+        show.on()
+        self.plt.render()
 
 
-    def computeProcessTIme(self, tic, toc):
-        processTime = toc - tic
+    def addProcessTime(self, processTime):
         self.sumProcessTime = self.sumProcessTime + processTime
         self.numProcessed = self.numProcessed + 1
         self.label_numProcessed.setText(f"{self.numProcessed} projects")
@@ -286,12 +406,15 @@ class MainWindow(QMainWindow):
         self.projectPaths = []
         self.sumProcessTime = .0
         self.numProcessed = 0
+        self.currentProject = None
+        self.jobs.clear()
         self.show_popup()
 
     def saveAndContinue(self):
         listWidgetItem = QListWidgetItem(self.resultPath)
         self.listWidget_savedProjects.addItem(listWidgetItem)
         print("added to list")
+        self.recordReview("saved")
         self.pushButton_dontSave.setEnabled(False)
         self.pushButton_saveAndContinue.setEnabled(False)
         self.pushButton_redo.setEnabled(False)
@@ -300,17 +423,34 @@ class MainWindow(QMainWindow):
     def deleteAndContinue(self):
         listWidgetItem = QListWidgetItem(self.resultPath)
         self.listWidget_unsavedProjects.addItem(listWidgetItem)
+        self.recordReview("deleted")
         self.pushButton_dontSave.setEnabled(False)
         self.pushButton_saveAndContinue.setEnabled(False)
         self.pushButton_redo.setEnabled(False)
-        os.remove(self.resultPath)
+        if os.path.isfile(self.resultPath):
+            os.remove(self.resultPath)
+        if os.path.isfile(getPreviewPath(self.resultPath)):
+            os.remove(getPreviewPath(self.resultPath))
         self.singleProcessing()
 
+    def recordReview(self, status):
+        # record the operator's decision on the displayed result in the manifest.
+        # a failed job stays recorded as failed, so that the project is processed again by the next run
+        projectPath = self.projectPaths[self.indPath - 1]
+        job = self.jobs[projectPath]
+        if job["status"] == "failed":
+            status = "failed"
+        self.manifest.record(projectPath, job["config"], status, job.get("resultPath"), job["processTime"], job.get("error"), job["inputs"])
+
     def redo(self):
         self.pushButton_dontSave.setEnabled(False)
         self.pushButton_saveAndContinue.setEnabled(False)
         self.pushButton_redo.setEnabled(False)
         self.indPath = self.indPath - 1
+        # retry a failed job
+        projectPath = self.projectPaths[self.indPath]
+        if self.jobs[projectPath]["status"] == "failed":
+            del self.jobs[projectPath]
         self.singleProcessing()
 
     def show_popup(self):
@@ -333,19 +473,103 @@ class MainWindow(QMainWindow):
             self.regression = HermesRegression()
 
         print("Generating regression model...")
-        self.regression.generateHBM(config)
+        predicted = self.regression.predictHBM(config)
+
+        if self.regressionModel is not None and self.regressionModel.setNodeCoords(self.regression.nids, predicted):
+            # the template model is up to date; the file is only needed outside of the viewer
+            self.writeRegressionInBackground(predicted)
+            if self.regressionMeshes is not None:
+                self.plt.render()
+                print("Done!")
+                return
+        else:
+            # the first time, write the result and read the k files (HERMES_main.k and its includes)
+            self.waitRegressionWrite()
+            self.regression.writeHBM(predicted)
 
-        # reading k files
-        allFilepaths = getAllKFilesInFolder("regression")
-        print(f"Reading {len(allFilepaths)} files: {allFilepaths}")
-        k_parser = DynaModel(args=allFilepaths)
-        verts, faces = k_parser.getAllPartsData(verbose=True)
+            allFilepaths = getAllKFilesInFolder("regression")
+            print(f"Reading {len(allFilepaths)} files: {allFilepaths}")
+            # unchanged files (e.g., hermes_includes.k) are loaded from the cache instead of being parsed again
+            self.regressionModel = DynaModel(args=allFilepaths, cacheDir=os.path.join("regression", ".cache"))
+
+        # one actor per part, so that a part can be hidden or recoloured without rebuilding the others
+        meshes = self.regressionModel.getDisplayMeshes(generate=True)
 
         print("Displaying object with vedo...")
-        m = Mesh([verts, faces])
-        self.display(m)
+        self.display(meshes)
+        self.regressionMeshes = meshes
         print("Done!")
 
+    def writeRegressionInBackground(self, predicted):
+        # the writes are done in order; wait for the pending one before replacing it
+        self.waitRegressionWrite()
+        self.regressionWrite = self.regressionWriter.submit(self.regression.writeHBM, predicted)
+        self.regressionWrite.add_done_callback(self.regressionWriteDone)
+
+    def waitRegressionWrite(self):
+        # its error (if any) is reported by regressionWriteDone
+        if self.regressionWrite is not None:
+            self.regressionWrite.exception()
+
+    def regressionWriteDone(self, future):
+        # called on the writer thread
+        if future.exception() is not None:
+            eprint(f"Could not write the regression model: {type(future.exception()).__name__}: {future.exception()}")
+
+    def regressionConfigChanged(self):
+        if self.checkBox_liveRegression.isChecked():
+            # throttle: the preview is updated (with the latest predictors) one interval after the first change,
+            # so it keeps up with a slider drag and also shows the last change
+            if not self.regressionPreviewTimer.isActive():
+                self.regressionPreviewTimer.start()
+
+    def updateRegressionPreview(self):
+        """
+        updateRegressionPreview predicts the HBM for the current predictors and moves the vertices of the displayed
+        mesh in place (no file is written, see startRegression)
+        """
+        if self.regressionMeshes is None:
+            # nothing to update yet; display the model once
+            self.startRegression()
+            return
+
+        config = self.configurator_regression.getConfig()
+        predicted = self.regression.predictHBM(config)
+        if self.regressionModel.setNodeCoords(self.regression.nids, predicted):
+            # the displayed meshes share the coordinates; the topology is kept and the plotter is not cleared
+            self.plt.render()
+
+
+class JobSignals(QObject):
+    progress = pyqtSignal(str, str) # project path, stage
+    finished = pyqtSignal(str, str, float, object) # project path, result path, process time, inputs (see Job.get_inputs)
+    failed = pyqtSignal(str, str, float, object) # project path, error, process time, inputs (None if not hashed)
+
+
+class JobWorker(QRunnable):
+    """
+    JobWorker runs the Job of a project on a thread of a QThreadPool and reports through its signals
+    """
+    def __init__(self, projectPath, outputPath, config):
+        super(JobWorker, self).__init__()
+        self.projectPath = projectPath
+        self.outputPath = outputPath
+        self.config = config
+        self.signals = JobSignals()
+
+    def run(self):
+        tic = time.perf_counter()
+        job = None
+        try:
+            job = Job(self.projectPath, self.outputPath, self.config, getStageCacheDir(self.outputPath))
+            # load, remove the background, apply the filters and save the mesh
+            job.start(lambda stage: self.signals.progress.emit(self.projectPath, stage))
+        except Exception as e:
+            inputs = job.inputs if job is not None else None
+            self.signals.failed.emit(self.projectPath, f"{type(e).__name__}: {e}", time.perf_counter() - tic, inputs)
+            return
+        self.signals.finished.emit(self.projectPath, job.getResultPath(), time.perf_counter() - tic, job.inputs)
+
 
 class DoubleSlider(QSlider):
 
@@ -3,11 +3,65 @@
 # -----------------------------------------------------------
 
 # %% standard lib imports
+from collections import OrderedDict
 import numpy as np
-import os
+import gzip, json, os, tempfile
 
 # %% first party imports
 from utils import *
+from utils_kparser import formatNodeBlock, setDefaultFileMode
+
+
+# Names of the predictors (the columns of a predictor table), see HermesRegression.predictBatch
+PREDICTOR_NAMES = ("sex", "stature", "bmi", "age", "shs")
+
+# BMI bands of the statistical model: low (< 22), mid (22 to 33) and high (>= 33)
+BMI_BANDS = ("low", "mid", "high")
+BMI_BAND_EDGES = (22, 33)
+
+
+def loadTextMatrix(filename: str, cacheDir: str, delimiter: str=None) -> np.ndarray:
+    """
+    loadTextMatrix loads a matrix stored as text through a binary copy (.npy) in cacheDir.
+    The text is only parsed the first time (or when the text file changed, i.e. its size or modification time);
+    the copy is memory-mapped read-only, so loading takes milliseconds and processes share the pages
+    """
+    stat = os.stat(filename)
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    binaryPath = os.path.join(cacheDir, os.path.basename(filename) + ".npy")
+    metaPath = binaryPath + ".json"
+
+    try:
+        with open(metaPath) as f:
+            if json.load(f) == source:
+                return np.load(binaryPath, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+
+    print(f"Converting {filename} to {binaryPath}...")
+    matrix = np.genfromtxt(filename, delimiter=delimiter)
+    tempname = None
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        # write to unique temporary files and rename them, so a reader never sees a partial file (even if several
+        # processes convert the same file); the meta file is written last, it marks a complete binary
+        with tempfile.NamedTemporaryFile("wb", dir=cacheDir, suffix=".npy.tmp", delete=False) as f:
+            tempname = f.name
+            np.save(f, matrix)
+        # readable by the other users of the folder, as the files created by open
+        setDefaultFileMode(tempname)
+        os.replace(tempname, binaryPath)
+        with tempfile.NamedTemporaryFile("w", dir=cacheDir, suffix=".json.tmp", delete=False) as f:
+            tempname = f.name
+            json.dump(source, f)
+        setDefaultFileMode(tempname)
+        os.replace(tempname, metaPath)
+    except OSError as e:
+        print(f"Could not write {binaryPath}: {e}")
+        if tempname is not None and os.path.exists(tempname):
+            os.remove(tempname)
+        return matrix
+    return np.load(binaryPath, mmap_mode='r')
 
 
 class HermesRegression:
@@ -15,88 +69,131 @@ class HermesRegression:
     HermesRegression is a class that contains all the regression methods for the Hermes project
     """
 
-    def __init__(self, folderPath: str=r'regression'):
-        # load the statistical model matrices
+    def __init__(self, folderPath: str=r'regression', cacheDir: str=None, maxCachedBands: int=2):
+        # the text matrices are converted to .npy files in cacheDir (regression/.cache by default) on first use
+        cacheDir = cacheDir if cacheDir is not None else os.path.join(folderPath, ".cache")
+
+        # the statistical model matrices (A_<sex>_int_<band>.txt) are loaded on first use, see getCoefficients
         # Question: are these matrices the same for all Hermes seats?
-        self.A_f_int_high = np.genfromtxt(os.path.join(folderPath, r'A_f_int_high.txt'), delimiter=',')
-        self.A_f_int_mid = np.genfromtxt(os.path.join(folderPath, r'A_f_int_mid.txt'), delimiter=',')
-        self.A_f_int_low = np.genfromtxt(os.path.join(folderPath, r'A_f_int_low.txt'), delimiter=',')
-        self.A_m_int_high = np.genfromtxt(os.path.join(folderPath, r'A_m_int_high.txt'), delimiter=',')
-        self.A_m_int_mid = np.genfromtxt(os.path.join(folderPath, r'A_m_int_mid.txt'), delimiter=',')
-        self.A_m_int_low = np.genfromtxt(os.path.join(folderPath, r'A_m_int_low.txt'), delimiter=',')
+        self._coefficients = OrderedDict()
+        self.maxCachedBands = maxCachedBands
 
         self.folderPath = folderPath
+        self.cacheDir = cacheDir
         # read nid for k file output
-        self.nids = np.genfromtxt(os.path.join(folderPath, r'disp_nid.txt')).astype(int)
+        self.nids = loadTextMatrix(os.path.join(folderPath, r'disp_nid.txt'), cacheDir).astype(int)
 
-    def generateHBM(self, config):
+    def getCoefficients(self, sex: int, band: str) -> np.ndarray:
         """
-        generateHBM generates the HBM for a given predictorsuration
+        getCoefficients returns the (3 * nodes, 8) matrix of the statistical model for a sex (1: male) and a BMI band.
+        The matrix is loaded on first use; at most maxCachedBands matrices are kept (least recently used first out)
+        """
+        key = f"A_{'m' if sex == 1 else 'f'}_int_{band}"
+        if key in self._coefficients:
+            self._coefficients.move_to_end(key)
+            return self._coefficients[key]
+
+        A = loadTextMatrix(os.path.join(self.folderPath, f"{key}.txt"), self.cacheDir, delimiter=',')
+        self._coefficients[key] = A
+        while len(self._coefficients) > max(self.maxCachedBands, 1):
+            self._coefficients.popitem(last=False)
+        return A
+
+    @staticmethod
+    def predictorTable(config) -> np.ndarray:
+        """
+        predictorTable returns the (1, predictors) table of the predictors in a configuration (see PREDICTOR_NAMES)
         """
-
-        # i_data = struct('stature',1700, 'age',45, 'BMI',25.6, 'sex',1, 'shs',0.52);
         predictors = config["predictors"]
+        return np.array([[predictors[name][1] for name in PREDICTOR_NAMES]], dtype=float)
+
+    @staticmethod
+    def designMatrix(table: np.ndarray) -> np.ndarray:
+        """
+        designMatrix returns the (S, 8) terms of the regression for an (S, predictors) table:
+        1, stature, bmi, age, shs, stature*bmi, stature*age, bmi*age
+        """
+        _, stature, bmi, age, shs = np.asarray(table, dtype=float).T
+        return np.column_stack((np.ones(len(stature)), stature, bmi, age, shs, stature*bmi, stature*age, bmi*age))
 
+    def iterPredictBatch(self, table: np.ndarray, chunkSize: int=256):
+        """
+        iterPredictBatch predicts the nodes of many subjects, one group of subjects at a time.
+        The subjects are grouped by sex and BMI band, and each group (of at most chunkSize subjects) is
+        evaluated with one matrix-matrix product.
+        Yields (rows, predicted) where rows are the indices of the subjects in the table and predicted is the
+        (len(rows), nodes, 3) array of their node coordinates
+        """
+        table = np.asarray(table, dtype=float).reshape(-1, len(PREDICTOR_NAMES))
+        terms = self.designMatrix(table)
+        isMale = table[:, 0] == 1
+        bands = np.digitize(table[:, 2], BMI_BAND_EDGES)
+
+        for sex in (1, 0):
+            for bandInd, band in enumerate(BMI_BANDS):
+                rows = np.flatnonzero((isMale == (sex == 1)) & (bands == bandInd))
+                if len(rows) == 0:
+                    continue
+                A = self.getCoefficients(sex, band)
+                for start in range(0, len(rows), chunkSize):
+                    chunk = rows[start:start + chunkSize]
+                    yield chunk, (terms[chunk] @ A.T).reshape((len(chunk), -1, 3))
+
+    def predictBatch(self, table: np.ndarray, out: np.ndarray=None, chunkSize: int=256) -> np.ndarray:
+        """
+        predictBatch predicts the nodes of many subjects given an (S, predictors) table (see PREDICTOR_NAMES).
+        Returns the (S, nodes, 3) array of the node coordinates. Use out to write the result into a given array,
+        e.g. np.lib.format.open_memmap to stream a large population to disk
+        """
+        table = np.asarray(table, dtype=float).reshape(-1, len(PREDICTOR_NAMES))
+        if out is None:
+            out = np.empty((len(table), len(self.nids), 3))
+        for rows, predicted in self.iterPredictBatch(table, chunkSize):
+            out[rows] = predicted
+        return out
+
+    def predictHBM(self, config) -> np.ndarray:
+        """
+        predictHBM returns the (nodes, 3) node coordinates of the HBM predicted for a given configuration (see self.nids)
+        """
+        # i_data = struct('stature',1700, 'age',45, 'BMI',25.6, 'sex',1, 'shs',0.52);
         # generate statsitically predicted HBMs
-        if predictors["sex"][1] == 1:
-            # male subjects
-            if predictors["bmi"][1] < 22:
-                predicted_model1 = np.dot(self.A_m_int_low,
-                                               np.array([1, predictors["stature"][1], predictors["bmi"][1], predictors["age"][1], predictors["shs"][1],
-                                                predictors["stature"][1]*predictors["bmi"][1], predictors["stature"][1]*predictors["age"][1],
-                                                predictors["bmi"][1]*predictors["age"][1]]).T).T
-            elif predictors["bmi"][1] >= 22 and predictors["bmi"][1] < 33:
-                predicted_model1 = np.dot(self.A_m_int_mid,
-                                               np.array([1, predictors["stature"][1],predictors["bmi"][1], predictors["age"][1], predictors["shs"][1],
-                                                predictors["stature"][1]*predictors["bmi"][1], predictors["stature"][1]*predictors["age"][1],
-                                                predictors["bmi"][1]*predictors["age"][1]]).T).T
-            else:
-                predicted_model1 = np.dot(self.A_m_int_high,
-                                               np.array([1, predictors["stature"][1], predictors["bmi"][1], predictors["age"][1], predictors["shs"][1],
-                                                predictors["stature"][1]*predictors["bmi"][1], predictors["stature"][1]*predictors["age"][1],
-                                                predictors["bmi"][1]*predictors["age"][1]]).T).T
-        else:
-            # female subjects
-            if predictors["bmi"][1] < 22:
-                predicted_model1 = np.dot(self.A_f_int_low,
-                                               np.array([1, predictors["stature"][1], predictors["bmi"][1], predictors["age"][1], predictors["shs"][1],
-                                                predictors["stature"][1]*predictors["bmi"][1], predictors["stature"][1]*predictors["age"][1],
-                                                predictors["bmi"][1]*predictors["age"][1]]).T).T
-            elif predictors["bmi"][1] >= 22 and predictors["bmi"][1] < 33:
-                predicted_model1 = np.dot(self.A_f_int_mid,
-                                               np.array([1, predictors["stature"][1], predictors["bmi"][1], predictors["age"][1], predictors["shs"][1],
-                                                predictors["stature"][1]*predictors["bmi"][1], predictors["stature"][1]*predictors["age"][1],
-                                                predictors["bmi"][1]*predictors["age"][1]]).T).T
-            else:
-                predicted_model1 = np.dot(self.A_f_int_high,
-                                               np.array([1,predictors["stature"][1],predictors["bmi"][1],predictors["age"][1],predictors["shs"][1],
-                                                predictors["stature"][1]*predictors["bmi"][1],predictors["stature"][1]*predictors["age"][1],
-                                                predictors["bmi"][1]*predictors["age"][1]]).T).T
-
-        # reshape matrix to x,y,z format (i.e. 3 columns)
-        predicted_model1 = predicted_model1.reshape((-1, 3))
+        return self.predictBatch(self.predictorTable(config))[0]
 
-        # write the result to HERMES_main.k
+    def writeHBM(self, predicted_model1: np.ndarray):
+        """
+        writeHBM writes the predicted node coordinates to HERMES_main.k
+        """
         self.WriteKfile_includes('HERMES_main.k', ["hermes_includes.k"], predicted_model1, self.folderPath)
 
+    def generateHBM(self, config):
+        """
+        generateHBM generates the HBM for a given predictorsuration
+        """
+        predicted_model1 = self.predictHBM(config)
 
-    def WriteKfile_includes(self, ExpFileName, IncludeFileNames, ExpData, FolderName):
-        print(f"Writing {ExpFileName} file to {FolderName}...")
+        # write the result to HERMES_main.k
+        self.writeHBM(predicted_model1)
+        return predicted_model1
 
-        # Replace the lines in the file
-        filename = os.path.join(FolderName, ExpFileName)
-        with open(filename, "w") as f:
-            print('*KEYWORD', end="\n", file=f)
-            print('*NODE', end="\n", file=f)
 
-            for i, node in enumerate(ExpData):
-                print(f"{self.nids[i]}, {node[0]}, {node[1]}, {node[2]}", end="\n", file=f)
+    def WriteKfile_includes(self, ExpFileName, IncludeFileNames, ExpData, FolderName, layout="csv", compress=False):
+        """
+        WriteKfile_includes writes the predicted nodes (a *NODE block) and the include files to a k file.
+        layout is the format of the NODE cards: "csv", "fixed" (8/16 fixed width) or "i10" (10/20 fixed width).
+        With compress, the file is gzip-compressed (".gz" is added to the file name)
+        """
+        filename = os.path.join(FolderName, ExpFileName) + (".gz" if compress else "")
+        print(f"Writing {os.path.basename(filename)} file to {FolderName}...")
 
-            for includeFileName in IncludeFileNames:
-                print('*INCLUDE', end="\n", file=f)
-                print(includeFileName, end="\n", file=f)
+        keyword = "*NODE %" if layout == "i10" else "*NODE"
+        includes = "".join(f"*INCLUDE\n{includeFileName}\n" for includeFileName in IncludeFileNames)
 
-            print('*END', end="\n", file=f)
+        # Replace the lines in the file (the lowest compression level, compressing takes longer than formatting)
+        with (gzip.open(filename, "wb", compresslevel=1) if compress else open(filename, "wb")) as f:
+            f.write(f"*KEYWORD\n{keyword}\n".encode())
+            f.write(formatNodeBlock(self.nids, ExpData, layout))
+            f.write(f"{includes}*END\n".encode())
 
 
 ## test
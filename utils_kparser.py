@@ -4,12 +4,17 @@
 # -----------------------------------------------------------
 
 # %% standard lib imports
-import copy, re
+import hashlib, mmap, os, re
+from contextlib import contextmanager
 from enum import Enum
+from itertools import accumulate
 from pathlib import Path
 from sys import stderr
 
+import numpy as np
 import vedo
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk, numpy_to_vtkIdTypeArray
 
 #===================================================================================================
 # Enums
@@ -40,25 +45,198 @@ class ELEMENT_TYPE(Enum):
     SOLID = 5
 
 
+# Faces of the solid elements (local node indices; triangles repeat their last node) by number of nodes,
+# oriented outwards for the node order of *ELEMENT_SOLID
+SOLID_FACES = {
+    4: ((0, 2, 1, 1), (0, 1, 3, 3), (1, 2, 3, 3), (0, 3, 2, 2)),
+    6: ((0, 2, 1, 1), (3, 4, 5, 5), (0, 1, 4, 3), (1, 2, 5, 4), (2, 0, 3, 5)),
+    8: ((0, 3, 2, 1), (4, 5, 6, 7), (0, 1, 5, 4), (1, 2, 6, 5), (2, 3, 7, 6), (3, 0, 4, 7)),
+}
+
+
 #===================================================================================================
 # Type classes
-class Node():
-    ''' Class for storing the information of a node
+class NodeStore():
+    ''' Columnar storage for all the nodes of a model
+
+    Nodes are collected with append() and reference() while parsing and merged into sorted arrays by
+    finalize(). Node objects are only created on demand as views into these arrays.
+
+    Attributes:
+        nids: int64 array of node ids (sorted), shape (N,)
+        coords: float64 array of coordinates, shape (N, 3)
+        sources: int64 array of (file index, line number), shape (N, 2).
+                 (-1, -1) if the node is referenced by an element but not defined in the k files
+        modified: bool array of modified flags (dirty bitmap of the nodes changed since the last save), shape (N,)
     '''
-    def __init__(self, nid, plist=(0, 0, 0), source: tuple[int, int]=None):
-        ''' Initialize the node with a list of coordinates and a line number
+    def __init__(self):
+        self.nids = np.empty(0, dtype=np.int64)
+        self.coords = np.empty((0, 3), dtype=np.float64)
+        self.sources = np.empty((0, 2), dtype=np.int64)
+        self.modified = np.empty(0, dtype=bool)
+
+        # nodes parsed but not yet merged into the arrays
+        self._pendingNids = []
+        self._pendingCoords = []
+        self._pendingSources = []
+
+        # node ids referenced by elements
+        self._referencedNids = []
+
+        # incremented whenever the arrays are rebuilt
+        self._generation = 0
+
+        # vtkPoints sharing the memory of coords (see vtkPoints) and the generation it was built for
+        self._vtkPoints = None
+        self._vtkPointsGeneration = -1
+
+        # row of each node id (-1 if none) from the smallest id, when the ids are dense (see indexOf),
+        # and the generation it was built for
+        self._rowTable = None
+        self._rowTableGeneration = -1
+
+    def __len__(self) -> int:
+        return len(self.nids)
+
+    def __contains__(self, nid) -> bool:
+        return self.indexOf(nid) >= 0
+
+    def append(self, nids: np.ndarray, coords: np.ndarray, sources: np.ndarray) -> None:
+        ''' Add a block of node definitions. They are merged into the arrays by finalize()
+
+        nids: (n,) node ids, coords: (n, 3) coordinates, sources: (n, 2) file indices and line numbers
         '''
-        # node id
-        self._nid = nid
+        self._pendingNids.append(np.asarray(nids, dtype=np.int64))
+        self._pendingCoords.append(np.asarray(coords, dtype=np.float64).reshape(-1, 3))
+        self._pendingSources.append(np.asarray(sources, dtype=np.int64).reshape(-1, 2))
 
-        # the coordinates are stored as a tuple
-        self._coord = plist
+    def reference(self, nids: np.ndarray) -> None:
+        ''' Record the node ids referenced by elements. Referenced nodes that are never defined are
+        added by finalize() with zero coordinates and no source
+        '''
+        self._referencedNids.append(np.asarray(nids, dtype=np.int64).ravel())
 
-        # source file index and line number
-        self._source = source
+    def finalize(self) -> None:
+        ''' Merge the pending nodes into the sorted arrays
 
-        # modified flag
-        self.modified = False
+        The first definition of a node id wins; repeated definitions are reported and disregarded.
+        '''
+        defined = self.sources[:, 0] >= 0
+        nids = np.concatenate([self.nids[defined]] + self._pendingNids)
+        coords = np.concatenate([self.coords[defined]] + self._pendingCoords)
+        sources = np.concatenate([self.sources[defined]] + self._pendingSources)
+        modified = np.concatenate((self.modified[defined], np.zeros(len(nids) - np.count_nonzero(defined), dtype=bool)))
+
+        # np.unique returns the index of the first occurrence of each nid
+        uniqueNids, firstInd = np.unique(nids, return_index=True)
+        if len(uniqueNids) != len(nids):
+            repeated = np.ones(len(nids), dtype=bool)
+            repeated[firstInd] = False
+            for i in np.flatnonzero(repeated):
+                eprint(f"Invalid NODE: Repeated node; id: {nids[i]}, coord: {tuple(coords[i])}")
+
+        # Add the nodes that are referenced but not defined
+        referenced = np.concatenate([self.nids[~defined]] + self._referencedNids)
+        undefined = np.setdiff1d(referenced, uniqueNids)
+
+        nids = np.concatenate((uniqueNids, undefined))
+        order = np.argsort(nids, kind='stable')
+        self.nids = nids[order]
+        self.coords = np.concatenate((coords[firstInd], np.zeros((len(undefined), 3))))[order]
+        self.sources = np.concatenate((sources[firstInd], np.full((len(undefined), 2), -1, dtype=np.int64)))[order]
+        self.modified = np.concatenate((modified[firstInd], np.zeros(len(undefined), dtype=bool)))[order]
+
+        self._pendingNids = []
+        self._pendingCoords = []
+        self._pendingSources = []
+        self._referencedNids = []
+
+        # the row indices changed; cached indices of the Node views are stale
+        self._generation += 1
+
+    def indexOf(self, nids):
+        ''' Return the row index of each node id (-1 if not found). Accepts a scalar or an array
+        '''
+        nids = np.asarray(nids, dtype=np.int64)
+        table = self.__rowTable() if nids.size >= 1024 else None
+        if table is not None:
+            # bulk lookups (e.g. the nodes of all the elements) are a single gather when the ids are dense
+            offsets = nids - self.nids[0]
+            inRange = (offsets >= 0) & (offsets < len(table))
+            return np.where(inRange, table[np.where(inRange, offsets, 0)], -1)
+        ind = np.searchsorted(self.nids, nids)
+        ind = np.minimum(ind, len(self.nids) - 1)
+        found = self.nids[ind] == nids if len(self.nids) else np.zeros(nids.shape, dtype=bool)
+        return np.where(found, ind, -1)
+
+    def __rowTable(self):
+        ''' Return the table of the row of each node id from the smallest one, or None if the ids are too sparse
+        (the table would be more than 4 times larger than the arrays)
+        '''
+        if self._rowTableGeneration != self._generation:
+            self._rowTableGeneration = self._generation
+            self._rowTable = None
+            if len(self.nids) and self.nids[-1] - self.nids[0] < 4 * len(self.nids):
+                self._rowTable = np.full(self.nids[-1] - self.nids[0] + 1, -1, dtype=np.int64)
+                self._rowTable[self.nids - self.nids[0]] = np.arange(len(self.nids))
+        return self._rowTable
+
+    def setCoords(self, rows: np.ndarray, coords: np.ndarray) -> None:
+        ''' Set the coordinates of the nodes in the given rows and mark them as modified
+        '''
+        self.coords[rows] = coords
+        self.modified[rows] = True
+
+        # the display meshes share the memory of coords; let them know that it changed
+        if self._vtkPoints is not None:
+            self._vtkPoints.Modified()
+
+    def vtkPoints(self):
+        ''' Return a vtkPoints that shares the memory of coords (one for all the display meshes of a model)
+        Coordinates set with setCoords are displayed without copying. finalize() replaces the arrays, so the
+        display meshes generated before it have to be generated again
+        '''
+        if self._vtkPoints is None or self._vtkPointsGeneration != self._generation:
+            self._vtkPoints = vtk.vtkPoints()
+            self._vtkPoints.SetData(numpy_to_vtk(self.coords, deep=False))
+            self._vtkPointsGeneration = self._generation
+        return self._vtkPoints
+
+    def view(self, nid: int):
+        ''' Return a Node view of the given node id
+        '''
+        return Node(self, nid)
+
+    def viewRows(self, rows):
+        ''' Return the Node views of the given rows (the row index is already known, no lookup needed)
+        '''
+        return [Node(self, nid, ind) for nid, ind in zip(self.nids[rows].tolist(), rows.tolist())]
+
+
+class Node():
+    ''' Lightweight view of a single node in a NodeStore
+    '''
+    __slots__ = ('_store', '_nid', '_ind', '_generation')
+
+    def __init__(self, store: NodeStore, nid: int, ind: int=-1):
+        ''' Initialize the view with the store that holds the node data and the node id
+        '''
+        self._store = store
+        self._nid = int(nid)
+
+        # row index in the store, resolved on first access unless given
+        self._ind = ind
+        self._generation = store._generation if ind >= 0 else -1
+
+    def _index(self) -> int:
+        store = self._store
+        if self._generation != store._generation:
+            ind = int(store.nids.searchsorted(self._nid))
+            self._ind = ind if ind < len(store.nids) and store.nids[ind] == self._nid else -1
+            self._generation = store._generation
+        if self._ind < 0:
+            raise KeyError(f"Node id: {self._nid} not in NodeStore")
+        return self._ind
 
     @property
     def nid(self):
@@ -70,27 +248,44 @@ class Node():
     def coord(self):
         ''' Return the coordinates of the node
         '''
-        return self._coord
+        store = self._store
+        ind = self._ind if self._generation == store._generation and self._ind >= 0 else self._index()
+        return tuple(store.coords[ind].tolist())
 
     @coord.setter
     def coord(self, value):
         ''' Set the coordinates of the node
         '''
         if isinstance(value, Node):  # passing a node
-            self._coord = copy.deepcopy(value._coord)
-        elif isinstance(value, tuple):  # passing a tuple or a list
-            self._coord = value
-        else:
+            value = value.coord
+        elif not isinstance(value, tuple):  # passing a tuple
             raise ValueError("Invalid input type for Node")
 
-        # set the modified flag
-        self.modified = True
+        # set the coordinates and the modified flag
+        self._store.setCoords(self._index(), value)
 
     @property
     def source(self):
         ''' Return the source of the node
         '''
-        return self._source
+        source = self._store.sources[self._index()]
+        return None if source[0] < 0 else tuple(source.tolist())
+
+    @property
+    def modified(self):
+        ''' Return the modified flag of the node
+        '''
+        return bool(self._store.modified[self._index()])
+
+    @modified.setter
+    def modified(self, value):
+        self._store.modified[self._index()] = value
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Node) and self._store is other._store and self._nid == other._nid
+
+    def __hash__(self) -> int:
+        return hash(self._nid)
 
     def __str__(self) -> str:
         return f"Node({self.coord})"
@@ -98,43 +293,234 @@ class Node():
     def toK(self, sep=", "):
         ''' Return the node in K format
         '''
-        return f" {self.nid}{sep}{self.coord[0]}{sep}{self.coord[1]}{sep}{self.coord[2]}"
+        coord = self.coord
+        return f" {self.nid}{sep}{coord[0]}{sep}{coord[1]}{sep}{coord[2]}"
+
+
+class ElementStore():
+    ''' Columnar storage for all the elements of one ELEMENT_TYPE
+
+    The nodes of the elements are stored in CSR format: the nodes of element i are the NodeStore rows
+    indices[indptr[i]:indptr[i+1]] (e.g., 4 or 8 for shells, 3 for beams). Elements are collected with
+    append() while parsing and merged into the arrays by finalize(). Element objects are only created on
+    demand as views into these arrays.
+
+    Attributes:
+        elementType: ELEMENT_TYPE
+        nodeStore: NodeStore that the node indices refer to
+        eids: int64 array of element ids, shape (M,). Negative if the id is used by an element of another
+              type first (see DynaModel)
+        priorEids: int64 array of element ids in the k files, shape (M,)
+        pids: int64 array of part ids, shape (M,)
+        indptr: int64 array, shape (M+1,)
+        indices: int64 array of NodeStore rows, shape (indptr[-1],)
+        sources: int64 array of (file index, line number), shape (M, 2)
+        modified: bool array of modified flags, shape (M,)
+    '''
+    def __init__(self, elementType: ELEMENT_TYPE, nodeStore: NodeStore):
+        self.elementType = elementType
+        self.nodeStore = nodeStore
 
+        self.eids = np.empty(0, dtype=np.int64)
+        self.priorEids = np.empty(0, dtype=np.int64)
+        self.pids = np.empty(0, dtype=np.int64)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.empty(0, dtype=np.int64)
+        self.sources = np.empty((0, 2), dtype=np.int64)
+        self.modified = np.empty(0, dtype=bool)
 
-class Element():
-    ''' Class for storing the information of an element
-    '''
-    def __init__(self, eid, nodes: list[Node]=[], type=ELEMENT_TYPE.UNKNOWN, source: tuple[int, int]=None, priorEid: int=None):
+        # order in which the elements were read (across all element types), used to resolve repeated ids
+        self.order = np.empty(0, dtype=np.int64)
 
-        # element id
-        self._eid = eid
+        # elements parsed but not yet merged into the arrays
+        self._pending = []
 
-        # nodes
-        self._nodes = nodes
+        # part id -> rows index: (sorted part ids, rows sorted by part id), rebuilt when pids change
+        self._pidIndex = None
 
-        # type
-        self._type = type
+    def __len__(self) -> int:
+        return len(self.eids)
 
-        # source file index and line number
-        self._source = source
+    def append(self, eids: np.ndarray, pids: np.ndarray, nodeIds: np.ndarray, sources: np.ndarray, order: np.ndarray) -> None:
+        ''' Add a block of elements. They are merged into the arrays by finalize()
 
-        # prior element id
-        self._priorEid = priorEid
+        nodeIds: (n, numNodes) node ids, 0 if blank
+        sources: (n, 2) file indices and line numbers
+        order: (n,) order in which the elements were read
+        '''
+        self._pending.append((eids, pids, nodeIds, sources, order))
 
-        # modified flag
-        self.modified = False
+    def finalize(self) -> None:
+        ''' Merge the pending elements into the arrays. The NodeStore must be finalized first
+
+        The first element with a given id wins; repeated elements of the same type are reported and disregarded.
+        '''
+        if not self._pending:
+            return
+
+        eids, pids, nodeIds, sources, order = (np.concatenate(arrays) for arrays in zip(*self._pending))
+        self._pending = []
+
+        # np.unique returns the index of the first occurrence of each eid
+        _, firstInd = np.unique(eids, return_index=True)
+        if len(firstInd) != len(eids):
+            repeated = np.ones(len(eids), dtype=bool)
+            repeated[firstInd] = False
+            for i in np.flatnonzero(repeated):
+                eprint(f"Repeated element: eid: {eids[i]}, pid: {pids[i]}, elementType: {self.elementType}")
+
+        # Keep the elements in the order they were read
+        keep = np.sort(firstInd)
+        nodeIds = nodeIds[keep]
+        valid = nodeIds != 0
+
+        self.priorEids = eids[keep]
+        self.eids = self.priorEids.copy()
+        self.pids = pids[keep]
+        self.indptr = np.concatenate(([0], np.cumsum(np.count_nonzero(valid, axis=1))))
+        self.indices = self.nodeStore.indexOf(nodeIds[valid])
+        self.sources = sources[keep]
+        self.modified = np.zeros(len(keep), dtype=bool)
+        self.order = order[keep]
+        self._pidIndex = None
+
+    def rowsOf(self, pid: int) -> np.ndarray:
+        ''' Return the rows of the elements of the given part (sorted)
+        '''
+        if self._pidIndex is None:
+            rows = np.argsort(self.pids, kind="stable")
+            self._pidIndex = (self.pids[rows], rows)
+        sortedPids, rows = self._pidIndex
+        return rows[np.searchsorted(sortedPids, pid, side="left"):np.searchsorted(sortedPids, pid, side="right")]
+
+    def setPids(self, rows: np.ndarray, pid: int) -> None:
+        ''' Move the elements in the given rows to another part
+        '''
+        self.pids[rows] = pid
+        self.modified[rows] = True
+        self._pidIndex = None
+
+    def setNodes(self, row: int, indices: np.ndarray) -> None:
+        ''' Replace the nodes (NodeStore rows) of an element
+        '''
+        start, end = self.indptr[row], self.indptr[row+1]
+        if len(indices) == end - start:
+            self.indices[start:end] = indices
+        else:
+            # The number of nodes changed; shift the following elements
+            self.indices = np.concatenate((self.indices[:start], indices, self.indices[end:]))
+            self.indptr[row+1:] += len(indices) - (end - start)
+        self.modified[row] = True
+
+    def view(self, row: int):
+        ''' Return an Element view of the given row
+        '''
+        return Element(self, row)
+
+    def faceIndices(self, rows: np.ndarray, width: int=0) -> np.ndarray:
+        ''' Return the NodeStore rows of the nodes of the given elements as a (len(rows), width) array
+        Elements with fewer nodes (e.g. triangles among quads) are padded by repeating their last node, the
+        same way LS-DYNA stores a triangular shell as a degenerate quad.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows+1] - starts
+        width = max(width, int(lengths.max(initial=0)))
+        cols = np.minimum(np.arange(width), np.maximum(lengths, 1)[:, None] - 1)
+        return self.indices[starts[:, None] + cols]
+
+    def surfaceIndices(self, rows: np.ndarray, width: int=0) -> np.ndarray:
+        ''' Return the NodeStore rows of the faces to display for the given elements as a (n, width) array
+        For solids these are the boundary faces of each part (see boundaryFaces); for the other element types,
+        the elements themselves (see faceIndices)
+        '''
+        if self.elementType is ELEMENT_TYPE.SOLID:
+            return padFaces(self.boundaryFaces(rows), width)
+        return self.faceIndices(rows, width)
+
+    def boundaryFaces(self, rows: np.ndarray) -> np.ndarray:
+        ''' Return the NodeStore rows of the boundary faces of the given solids as a (n, 4) array (triangles
+        repeat their last node)
+
+        A face is on the boundary of a part if no other element of the same part has a face with the same nodes.
+        The faces are compared by their sorted nodes (sorted-face hashing), so that only the skin of a solid part
+        is displayed instead of every element.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        nodes, numNodes = self.__solidNodes(rows)
+        faces, pids = [], []
+        for n, table in SOLID_FACES.items():
+            selected = numNodes == n
+            faces.append(nodes[selected][:, table].reshape(-1, 4))
+            pids.append(np.repeat(self.pids[rows[selected]], len(table)))
+        faces = np.concatenate(faces)
+        pids = np.concatenate(pids)
+
+        # Collapse the repeated nodes of degenerate faces (e.g. of a pentahedron stored as a hexahedron)
+        sortedNodes = np.sort(faces, axis=1)
+        numUnique = 1 + np.count_nonzero(sortedNodes[:, 1:] != sortedNodes[:, :-1], axis=1)
+        repeated = faces == np.roll(faces, 1, axis=1)
+        faces = np.take_along_axis(faces, np.argsort(repeated, axis=1, kind="stable"), axis=1)
+        triangle = numUnique == 3
+        faces[triangle, 3] = faces[triangle, 2]
+        valid = numUnique >= 3
+        faces, pids, triangle = faces[valid], pids[valid], triangle[valid]
+
+        # Key of a face: part id and sorted nodes (-1 instead of the repeated node of a triangle)
+        keys = np.column_stack((pids, np.sort(np.where(triangle[:, None] & (np.arange(4) == 3), -1, faces), axis=1)))
+        order = np.lexsort(keys.T[::-1])
+        keys = keys[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+        group = np.cumsum(first) - 1
+        single = np.bincount(group)[group] == 1
+        return faces[np.sort(order[single])]
+
+    def vtkCells(self, rows: np.ndarray):
+        ''' Return a vtkCellArray of the polygons of the given shells (the point ids are NodeStore rows)
+
+        Degenerate shells are written the way LS-DYNA stores them: a shell whose last two nodes are the same is
+        a triangle. Solids are displayed by their boundary faces instead (see boundaryFaces)
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        nodes = self.faceIndices(rows)
+        lengths = self.indptr[rows+1] - self.indptr[rows]
+        triangle = (lengths == 3) | ((lengths == 4) & (nodes[:, 2] == nodes[:, -1]))
+        numNodes = np.where(triangle, 3, lengths)
+        return buildCellArray(nodes, numNodes)
+
+    def __solidNodes(self, rows: np.ndarray):
+        ''' Return the nodes of the given solids as a (len(rows), 8) array and their number of distinct corner
+        nodes: 4 (tetrahedron: 4 nodes or the last five nodes the same), 6 (wedge) or 8 (hexahedron)
+        '''
+        nodes = self.faceIndices(rows, 8)
+        lengths = self.indptr[rows+1] - self.indptr[rows]
+        tetra = (lengths == 4) | ((lengths == 8) & np.all(nodes[:, 4:] == nodes[:, 3:4], axis=1))
+        return nodes, np.where(tetra, 4, np.where(lengths == 6, 6, 8))
+
+
+class Element():
+    ''' Lightweight view of a single element in an ElementStore
+    '''
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store: ElementStore, row: int):
+        ''' Initialize the view with the store that holds the element data and the row of the element
+        '''
+        self._store = store
+        self._row = int(row)
 
     @property
     def eid(self):
         ''' Return the element id of the element
         '''
-        return self._eid
+        return int(self._store.eids[self._row])
 
     @property
     def nodes(self):
         ''' Return the nodes of the element
         '''
-        return self._nodes
+        return self._store.nodeStore.viewRows(self.nodeIndices)
 
     @nodes.setter
     def nodes(self, value):
@@ -142,60 +528,80 @@ class Element():
         '''
         # NOTE: there can be duplicate nodes in an element
         if is_sequence(value) and all(isinstance(node, Node) for node in value):
-            self._nodes = value
+            indices = self._store.nodeStore.indexOf([node.nid for node in value])
+            if np.any(indices < 0):
+                raise ValueError("Node not in the model")
+            # set the modified flag
+            self._store.setNodes(self._row, indices)
         else:
             raise ValueError("Invalid input type for Element")
 
-        # set the modified flag
-        self.modified = True
+    @property
+    def nodeIndices(self):
+        ''' Return the NodeStore rows of the nodes of the element
+        '''
+        store = self._store
+        return store.indices[store.indptr[self._row]:store.indptr[self._row+1]]
 
     @property
     def type(self):
         ''' Return the type of the element
+        NOTE: elements are stored per type, therefore the type cannot be changed
         '''
-        return self._type
+        return self._store.elementType
 
-    @type.setter
-    def type(self, value):
-        ''' Set the type of the element
+    @property
+    def pid(self):
+        ''' Return the part id of the element
         '''
-        if isinstance(value, ELEMENT_TYPE):
-            self._type = value
-        else:
-            raise ValueError("Invalid input type for Element")
-
-        # set the modified flag
-        self.modified = True
+        return int(self._store.pids[self._row])
 
     @property
     def source(self):
         ''' Return the source of the element
         '''
-        return self._source
+        return tuple(self._store.sources[self._row].tolist())
 
     @property
     def priorEid(self):
         ''' Return the prior element id of the element
         '''
-        return self._priorEid
+        return int(self._store.priorEids[self._row])
+
+    @property
+    def modified(self):
+        ''' Return the modified flag of the element
+        '''
+        return bool(self._store.modified[self._row])
+
+    @modified.setter
+    def modified(self, value):
+        self._store.modified[self._row] = value
 
-    def toK(self, pid, sep=", "):
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Element) and self._store is other._store and self._row == other._row
+
+    def __hash__(self) -> int:
+        return hash((id(self._store), self._row))
+
+    def toK(self, pid=None, sep=", "):
         ''' Return the element in K format
         '''
+        pid = self.pid if pid is None else pid
         return f" {self.priorEid}{sep}{pid}{sep}{sep.join([str(node.nid) for node in self.nodes])}"
 
 
 class Part():
     ''' Class for storing the information of a part
     '''
-    def __init__(self, pid, elements: list[Element]=[], elementType: ELEMENT_TYPE=ELEMENT_TYPE.UNKNOWN, source: tuple[int, int, int]=None, header: str="", secid: int=0, mid: int=0, eosid: int=0, hgid: int=0, grav: int=0, adpopt: int=0, tmid: int=0):
-        ''' Initialize the part with a list of elements and a line number
+    def __init__(self, pid, elementStore: ElementStore=None, elementType: ELEMENT_TYPE=ELEMENT_TYPE.UNKNOWN, source: tuple[int, int, int]=None, header: str="", secid: int=0, mid: int=0, eosid: int=0, hgid: int=0, grav: int=0, adpopt: int=0, tmid: int=0):
+        ''' Initialize the part with the store of its elements and a line number
         '''
         # part id
         self._pid = pid
 
-        # the elements are stored as a set
-        self._elements = set(elements)
+        # the elements are the rows of the element store with this part id
+        self._elementStore = elementStore
 
         # element type
         self._elementType = elementType
@@ -216,6 +622,10 @@ class Part():
         # modified flag
         self.modified = False
 
+        # display mesh (vedo Mesh of the shells or of the skin of the solids, see update_display_mesh) and its parameters
+        self.display_mesh = None
+        self._parameters = {'color': None, 'alpha': 1.0, 'visible': True}
+
     @property
     def pid(self):
         ''' Return the part id of the part
@@ -224,22 +634,49 @@ class Part():
 
     @property
     def elements(self):
-        ''' Return the elements of the part
+        ''' Return the elements of the part (views into the element store)
         '''
-        return self._elements
+        if self._elementStore is None:
+            return set()
+        return {self._elementStore.view(row) for row in self.elementRows}
 
     @elements.setter
     def elements(self, value):
         ''' Set the elements of the part
+        The part id of the given elements is set to this part. The part of an element is its part id, so an element
+        can only leave the part by being set to the elements of another part first
         '''
-        if is_sequence(value) and all(isinstance(elem, Element) for elem in value):
-            self._elements = set(value)
-        else:
+        if not (is_sequence(value) and all(isinstance(elem, Element) for elem in value)):
             raise ValueError("Invalid input type for Part")
 
+        # each Part can only have one type of elements
+        value = list(value)
+        if self._elementStore is None and value:
+            self._elementStore = value[0]._store
+            self._elementType = self._elementStore.elementType
+        if any(elem._store is not self._elementStore for elem in value):
+            raise ValueError("Part's element type mismatch")
+
+        store = self._elementStore
+        if store is None:
+            return
+        rows = np.array([elem._row for elem in value], dtype=np.int64)
+        if len(np.setdiff1d(self.elementRows, rows)):
+            raise ValueError(f"Elements can only be removed from PART {self._pid} by adding them to another part")
+        # only the elements that move to this part are modified
+        store.setPids(rows[store.pids[rows] != self._pid], self._pid)
+
         # set the modified flag
         self.modified = True
 
+    @property
+    def elementRows(self):
+        ''' Return the rows of the part's elements in the element store
+        '''
+        if self._elementStore is None:
+            return np.empty(0, dtype=np.int64)
+        return self._elementStore.rowsOf(self._pid)
+
     @property
     def elementType(self):
         ''' Return the element type of the part
@@ -411,63 +848,77 @@ class Part():
     def getPartData(self):
         ''' Return the PART data given its ID
 
-            verts = list of coordinates of the corresponding element shells.
-                    e.g. [(x1,y1,z1),(x2,y2,z2),(x3,y3,z3),(x4,y4,z4),(x5,y5,z5),(x6,y6,z6)]
-            faces = indices of the corresponding nodes in verts (compatible with vedo's
-                    mesh constructor)
-                    e.g. [[n1_ind,n2_ind,n3_ind,n4_ind],[n4_ind,n5_ind,n6_ind]]
+            verts = (N, 3) array of the coordinates of the nodes of the part's elements.
+                    e.g. [[x1,y1,z1],[x2,y2,z2],[x3,y3,z3],[x4,y4,z4],[x5,y5,z5],[x6,y6,z6]]
+            faces = (M, k) array of the indices of the corresponding nodes in verts (compatible with vedo's
+                    mesh constructor); triangles among quads repeat their last node.
+                    e.g. [[n1_ind,n2_ind,n3_ind,n4_ind],[n4_ind,n5_ind,n6_ind,n6_ind]]
         '''
-
-        # Create a set of the vertices that only appear in the part
-        verts = list({v.coord for element in self.elements for v in element.nodes})
-
-        # Create a mapping from the new vertex list to the new index
-        vert_map = dict(zip(verts, range(len(verts))))
-
-        # Iterate over the reduced vertex list and update the face indices
-        faces = [[vert_map[v.coord] for v in element.nodes] for element in self.elements]
-        return verts, faces
+        if self._elementStore is None:
+            return buildMeshData(None, np.empty((0, 0), dtype=np.int64))
+        return buildMeshData(self._elementStore.nodeStore, self._elementStore.surfaceIndices(self.elementRows))
 
     def toK(self, sep=", "):
         ''' Return the part in K format
         '''
         return f"{self._header}\n {self.pid}{sep}{self._secid}{sep}{self._mid}{sep}{self._eosid}{sep}{self._hgid}{sep}{self._grav}{sep}{self._adpopt}{sep}{self._tmid}"
 
-    def update_display_mesh(self, generate=False):  #
-        """
-        update the display mesh and apply parameters
-        use generate=True to force creation of the display mesh, e.g., when first creating the part
-        subsequently, if only the node locations have changed, use generate=False
-        """
+    def update_display_mesh(self, generate=False):
+        ''' Update the display mesh and apply the display parameters (see setDisplayParameters)
+        Use generate=True to create the display mesh, e.g., when first creating the part. The display meshes of a
+        model share the vtkPoints of its NodeStore, so when only the node locations have changed, use
+        generate=False (nothing is tessellated or copied)
+        '''
         if generate:
-            print('in generate with self._elementType', self.elementType)
-            print('ELEMENT_TYPE.SHELL:', ELEMENT_TYPE.SHELL)
-            print('value: ', self._elementType.value)
-            print('same? ', self._elementType is ELEMENT_TYPE.SHELL)
-            if self._elementType is ELEMENT_TYPE.SOLID: # #NOTE I needed to change these to value to get them to match; I don't know why
-                print(f"SOLID! {self._header}")
-            elif self._elementType == ELEMENT_TYPE.SHELL:
-                print(f"SHELL! {self._header}")
+            self.display_mesh = None
+            rows = self.elementRows
+            if len(rows) == 0:
+                eprint(f"Can't generate display mesh for {self._header} without elements")
+                return None
+
+            polydata = vtk.vtkPolyData()
+            polydata.SetPoints(self._elementStore.nodeStore.vtkPoints())
+            if self._elementType is ELEMENT_TYPE.SOLID:
+                # only the skin of the part is displayed (its boundary faces, see ElementStore.boundaryFaces)
+                faces = self._elementStore.boundaryFaces(rows)
+                polydata.SetPolys(buildCellArray(faces, np.where(faces[:, 2] == faces[:, 3], 3, 4)))
+            elif self._elementType is ELEMENT_TYPE.SHELL:
+                polydata.SetPolys(self._elementStore.vtkCells(rows))
             else:
-                print(f"Can't generate display mesh for {self._header} of {self._elementType} type")
+                eprint(f"Can't generate display mesh for {self._header} of {self._elementType} type")
+                return None
+            self.display_mesh = vedo.Mesh(polydata)
+            self.display_mesh.name = f"PART {self._pid}"
 
-        else:
-            if self.display_mesh:
-                self.display_mesh.points(self._model.node_coords) # this should update in place without copying? (all parts access the same list)
+        elif self.display_mesh is not None:
+            # the coordinates are shared, only tell VTK that they changed
+            self.display_mesh.GetMapper().GetInput().GetPoints().Modified()
 
-            # if isinstance(self.display_mesh, vedo.UGrid):
-                # index_list = self.node_coord_index_list # index_list = list(kp.partsDict.values())[90].node_coord_index_list
+        self.__applyDisplayParameters()
+        return self.display_mesh
 
+    def setDisplayParameters(self, color=None, alpha: float=None, visible: bool=None):
+        ''' Set the colour, opacity or visibility of the display mesh (None keeps the current value)
+        '''
+        for key, value in (('color', color), ('alpha', alpha), ('visible', visible)):
+            if value is not None:
+                self._parameters[key] = value
 
-                # update based on params
-                self.display_mesh.c(self._parameters['color']).alpha(self._parameters['alpha'])
-                if self._parameters['visible']:
-                    self.display_mesh.on()
-                else:
-                    self.display_mesh.off()
+        # only the properties of the actor change
+        self.__applyDisplayParameters()
 
-        # return self.display_mesh
-        return None
+    def __applyDisplayParameters(self):
+        ''' Apply the display parameters to the display mesh
+        '''
+        if self.display_mesh is None:
+            return
+        if self._parameters['color'] is not None:
+            self.display_mesh.c(self._parameters['color'])
+        self.display_mesh.alpha(self._parameters['alpha'])
+        if self._parameters['visible']:
+            self.display_mesh.on()
+        else:
+            self.display_mesh.off()
 
 
 
@@ -496,24 +947,416 @@ def is_sequence(arg):
     return False
 
 
+def buildMeshData(nodeStore: NodeStore, faceIndices: np.ndarray):
+    ''' Return the vertices and faces of a mesh given the NodeStore rows of its faces
+    The vertices are the nodes referenced by the faces (deduplicated by node, not by coordinate); the faces are
+    remapped to index the vertices.
+    '''
+    if faceIndices.size == 0:
+        return np.empty((0, 3)), np.empty(faceIndices.shape, dtype=np.int64)
+    uniqueIndices, faces = np.unique(faceIndices, return_inverse=True)
+    return nodeStore.coords[uniqueIndices], faces.reshape(faceIndices.shape)
+
+
+def padFaces(faces: np.ndarray, width: int) -> np.ndarray:
+    ''' Pad the faces to (at least) the given number of nodes by repeating their last node
+    '''
+    if faces.shape[1] >= width:
+        return faces
+    if len(faces) == 0 or faces.shape[1] == 0:
+        return np.empty((len(faces), width), dtype=np.int64)
+    return np.concatenate((faces, np.repeat(faces[:, -1:], width - faces.shape[1], axis=1)), axis=1)
+
+
+def buildCellArray(nodes: np.ndarray, numNodes: np.ndarray):
+    ''' Return a vtkCellArray whose cell i is made of the first numNodes[i] nodes of row i
+    '''
+    keep = np.arange(nodes.shape[1]) < numNodes[:, None]
+    offsets = np.concatenate(([0], np.cumsum(numNodes))).astype(np.int64)
+    cells = vtk.vtkCellArray()
+    cells.SetData(numpy_to_vtkIdTypeArray(offsets, deep=True), numpy_to_vtkIdTypeArray(nodes[keep].astype(np.int64), deep=True))
+    return cells
+
+
 def getAllKFilesInFolder(folderPath: str) -> list[str]:
     ''' Return a list of all .k files in the folder
     '''
     return list(Path(folderPath).glob('*.k'))
 
 
-def splitString(s, groupLengths, enforcedGroups):
-    ''' Split a string into groups of specified lengths
-    s: string to split
-    groupLengths: list of group lengths
-    enforcedGroups: list of booleans indicating whether the group is enforced
+@contextmanager
+def openKFileData(filename: str, useMmap: bool=True):
+    ''' Open a k file as a read-only bytes-like object
+    With useMmap, the file is memory-mapped (zero-copy) instead of read into memory. Slices of a memoryview
+    of the data can be scanned without copying; only the parts that are needed as strings are decoded.
+    '''
+    with open(filename, "rb") as reader:
+        # NOTE: empty files cannot be memory-mapped
+        if not useMmap or os.fstat(reader.fileno()).st_size == 0:
+            yield reader.read()
+        else:
+            with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+
+def hashFile(filename: str, chunkSize: int=1 << 24) -> str:
+    ''' Return the SHA-1 hex digest of the file content
+    '''
+    digest = hashlib.sha1()
+    with open(filename, "rb") as reader:
+        while chunk := reader.read(chunkSize):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# The umask of the process, read once (os.umask can only be read by setting it, which is not thread-safe)
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def setDefaultFileMode(filename: str) -> None:
+    ''' Give a file created by tempfile (mode 0600) the permissions of a file created by open (0666 minus the umask)
+    '''
+    os.chmod(filename, 0o666 & ~_UMASK)
+
+
+def countNewlines(data, start: int, end: int, chunkSize: int=1 << 24) -> int:
+    ''' Count the line breaks in data[start:end]. Works on bytes and mmap objects (which have no count method)
+    '''
+    if isinstance(data, bytes):
+        return data.count(b'\n', start, end)
+
+    count = 0
+    for chunkStart in range(start, end, chunkSize):
+        chunk = np.frombuffer(data, dtype=np.uint8, count=min(chunkSize, end - chunkStart), offset=chunkStart)
+        count += int(np.count_nonzero(chunk == ord('\n')))
+    return count
+
+
+def scanKeywordLines(data):
+    ''' Yield (line number, start offset, end offset) of every keyword line in the k file data (bytes or mmap)
+    A keyword line starts with '*' (leading whitespace is allowed). The end offset excludes the line break
+
+    NOTE: '*' hardly ever appears in data lines, so jumping from one '*' to the next is much faster than
+    looking at every line
+    '''
+    lineNum = 0
+    prevStart = 0
+    pos = data.find(b'*')
+    while pos != -1:
+        lineStart = data.rfind(b'\n', 0, pos) + 1
+        if not data[lineStart:pos].strip(b' \t'):
+            lineEnd = data.find(b'\n', pos)
+            lineEnd = len(data) if lineEnd == -1 else lineEnd
+
+            lineNum += countNewlines(data, prevStart, lineStart)
+            prevStart = lineStart
+            yield lineNum, lineStart, lineEnd
+
+            pos = lineEnd
+        pos = data.find(b'*', pos + 1)
+
+
+def splitLines(data, start: int, end: int, chunkSize: int):
+    ''' Split data[start:end] into line-aligned ranges of about chunkSize bytes
+    Yield (chunk start offset, chunk end offset)
+    '''
+    while end - start > chunkSize:
+        chunkEnd = data.find(b'\n', start + chunkSize, end) + 1
+        if chunkEnd == 0:
+            break
+        yield start, chunkEnd
+        start = chunkEnd
+    if start < end:
+        yield start, end
+
+
+def lineOffsets(data, lineNums: np.ndarray, chunkSize: int=1 << 24) -> np.ndarray:
+    ''' Return the start offset of each of the given lines (len(data) for lines past the end of the data)
+    '''
+    lineNums = np.asarray(lineNums, dtype=np.int64)
+    offsets = np.where(lineNums <= 0, 0, len(data)).astype(np.int64)
+    lastLine = int(lineNums.max(initial=0))
+
+    # line k+1 starts after the k-th line break (counting from 0)
+    numNewlines = 0
+    for chunkStart in range(0, len(data), chunkSize):
+        chunk = np.frombuffer(data, dtype=np.uint8, count=min(chunkSize, len(data) - chunkStart), offset=chunkStart)
+        newlines = np.flatnonzero(chunk == ord('\n')) + chunkStart
+        inChunk = (lineNums > numNewlines) & (lineNums <= numNewlines + len(newlines))
+        offsets[inChunk] = newlines[lineNums[inChunk] - numNewlines - 1] + 1
+        numNewlines += len(newlines)
+        if numNewlines >= lastLine:
+            break
+    return offsets
+
+
+def formatFixedField(value, width: int) -> str:
+    ''' Format a number right-justified in a fixed-width field, reducing the precision of floats to fit
+    A blank is kept in front of the number if possible, so that the fields stay separated (see decodeCards).
+    Return None if the value does not fit
+    '''
+    isFloat = isinstance(value, (float, np.floating))
+    text = repr(float(value)) if isFloat else str(value)
+    precision = width - 2
+    while isFloat and len(text) > width - 1 and precision > 0:
+        text = f"{value:.{precision}g}"
+        precision -= 1
+    return text.rjust(width) if len(text) <= width else None
+
+
+def formatCard(values: list, line: str, widths: list[int], keepTail: bool=True) -> str:
+    ''' Format a data card with new values, following the format of the line it replaces
+
+    values: new values of the first fields
+    line: original line (without the line break)
+    widths: field lengths of the fixed-width format of the card
+    keepTail: keep the fields of the original line after the replaced ones (e.g. tc and rc of a NODE)
+
+    A line without commas whose fields end on the fixed-width field boundaries is written in fixed-width
+    format (with the same field lengths). Any other line, or a value that does not fit its field, is written
+    in comma-separated free format (a line without commas is read as fixed-width by LS-DYNA).
+    '''
+    tokens = list(re.finditer(r'[^,\s]+', line))
+    boundaries = set(accumulate(widths))
+    if ',' not in line and tokens and all(token.end() in boundaries or token.end() > sum(widths) for token in tokens):
+        fields = [formatFixedField(value, width) for value, width in zip(values, widths)]
+        if all(field is not None for field in fields):
+            tail = line[sum(widths[:len(values)]):] if keepTail else ""
+            return "".join(fields) + tail
+
+    indent = line[:tokens[0].start()] if tokens else " "
+    tail = [token.group() for token in tokens[len(values):]] if keepTail else []
+    return indent + ", ".join([str(value) for value in values] + tail)
+
+
+# Fixed-width layouts of the NODE cards written by formatNodeBlock: field widths of the node id and the coordinates
+NODE_LAYOUTS = {
+    "fixed": (8, 16),
+    "i10": (10, 20),
+}
+
+
+def _digits(values: np.ndarray, count: int) -> np.ndarray:
+    ''' Return the (n, count) uint8 array of the characters of the decimal digits of non-negative integers,
+    least significant first
+    '''
+    digits = np.empty((len(values), count), dtype=np.uint8)
+    values = values.copy()
+    for i in range(count):
+        digits[:, i] = values % 10
+        values //= 10
+    digits += ord('0')
+    return digits
+
+
+def _formatIntColumn(values: np.ndarray, width: int) -> tuple[np.ndarray, np.ndarray]:
+    ''' Format integers right-justified in fields of the given width
+    Return the (n, width) uint8 array of characters and a mask of the values that do not fit
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    neg = values < 0
+    absValues = np.abs(values)
+    numDigits = np.ones(len(values), dtype=np.int64)
+    for power in range(1, 19):
+        numDigits += absValues >= 10**power
+    overflow = numDigits + neg > width
+
+    # k-th character from the right: digits, sign
+    k = np.arange(width, dtype=np.int8)[::-1]
+    numDigits = numDigits.astype(np.int8)
+    chars = np.where(k < numDigits[:, None], _digits(absValues, width)[:, ::-1], ord(' ')).astype(np.uint8)
+    chars[neg[:, None] & (k == numDigits[:, None])] = ord('-')
+    return chars, overflow
+
+
+def _formatFixedPoint(values: np.ndarray, width: int, numIntDigits: int, decimals: int) -> np.ndarray:
+    ''' Format floats with the same number of integer digits and decimals right-justified in fields of the given width
+    Return the (n, width) uint8 array of characters
+    '''
+    # the value as an integer number of 10**-decimals, and its digits (least significant first)
+    scaled = np.rint(np.abs(values) * 10.0**decimals).astype(np.int64)
+    digits = _digits(scaled, numIntDigits + decimals)
+    point = width - 1 - decimals
+
+    chars = np.full((len(values), width), ord(' '), dtype=np.uint8)
+    chars[:, point+1:] = digits[:, decimals-1::-1]
+    chars[:, point] = ord('.')
+    chars[:, point-numIntDigits:point] = digits[:, :decimals-1:-1]
+    chars[(values < 0) & (scaled != 0), point-numIntDigits-1] = ord('-')
+    return chars
+
+
+def _formatFloatColumn(values: np.ndarray, width: int) -> tuple[np.ndarray, np.ndarray]:
+    ''' Format floats in fixed-point notation right-justified in fields of the given width (with a leading blank)
+    Each value gets as many decimals as fit, up to 15 significant digits.
+    Return the (n, width) uint8 array of characters and a mask of the values that do not fit (or are not finite)
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    maxIntDigits = min(width - 4, 14)
+    absValues = np.abs(values)
+    overflow = ~(absValues < 10.0**maxIntDigits)
+    absValues[overflow] = 0.0
+
+    # digits of the integer part and decimals that fit in the field (rounding can add a digit, e.g. 9.99 -> 10.0)
+    numIntDigits = np.ones(len(values), dtype=np.int64)
+    for power in range(1, maxIntDigits + 1):
+        numIntDigits += absValues >= 10.0**power
+    decimals = np.minimum(width - 3 - numIntDigits, 15 - numIntDigits)
+    numIntDigits += np.rint(absValues * 10.0**decimals) >= 10.0**(numIntDigits + decimals)
+    decimals = np.minimum(width - 3 - numIntDigits, 15 - numIntDigits)
+    overflow |= decimals < 1
+
+    # format the values with the same number of integer digits together
+    chars = np.full((len(values), width), ord(' '), dtype=np.uint8)
+    for numDigits in np.unique(numIntDigits[~overflow]).tolist():
+        rows = np.flatnonzero((numIntDigits == numDigits) & ~overflow)
+        chars[rows] = _formatFixedPoint(values[rows], width, numDigits, int(decimals[rows[0]]))
+    return chars, overflow
+
+
+def formatNodeBlock(nids: np.ndarray, coords: np.ndarray, layout: str="csv") -> bytes:
+    ''' Format the data cards of a NODE block in one pass (without the keyword line)
+
+    layout: "csv" (free format: "nid, x, y, z"), "fixed" (LS-DYNA fixed width: I8, 3E16) or "i10" (I10, 3E20;
+            the keyword line must be "*NODE %")
+    In free format, the coordinates keep their full precision (the shortest representation that reads back the
+    same value, as repr). In fixed width, they are written in fixed-point notation with as many decimals as fit
+    (up to 15 significant digits), and nodes that do not fit the fields are written in free format.
+    '''
+    nids = np.asarray(nids, dtype=np.int64).ravel()
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    if len(nids) != len(coords):
+        raise ValueError(f"Expected {len(nids)} coordinates, received {len(coords)}")
+    if len(nids) == 0:
+        return b''
+    if layout == "csv":
+        return "".join(f"{nid}, {x!r}, {y!r}, {z!r}\n" for nid, (x, y, z) in zip(nids.tolist(), coords.tolist())).encode()
+    idWidth, coordWidth = NODE_LAYOUTS[layout]
+
+    columns = [_formatIntColumn(nids, idWidth)] + [_formatFloatColumn(coords[:, i], coordWidth) for i in range(3)]
+    overflow = np.any([columnOverflow for _, columnOverflow in columns], axis=0)
+    lines = np.hstack([chars for chars, _ in columns] + [np.full((len(nids), 1), ord('\n'), dtype=np.uint8)])
+    lineEnds = np.arange(1, len(nids) + 1) * lines.shape[1]
+    data = lines.ravel().tobytes()
+    if not np.any(overflow):
+        return data
+
+    # Nodes that do not fit the fields
+    pieces = []
+    prevEnd = 0
+    for i in np.flatnonzero(overflow).tolist():
+        pieces.append(data[prevEnd:lineEnds[i-1] if i > 0 else 0])
+        pieces.append(f"{nids[i]}, {coords[i, 0]!r}, {coords[i, 1]!r}, {coords[i, 2]!r}\n".encode())
+        prevEnd = lineEnds[i]
+    pieces.append(data[prevEnd:])
+    return b''.join(pieces)
+
+
+# Bytes treated as separators in free-format cards: space, tab, comma, CR, LF, FF, VT
+_SEPARATORS = np.zeros(256, dtype=bool)
+_SEPARATORS[[ord(c) for c in ' \t,\r\n\f\v']] = True
+
+
+def _gatherStrings(buf: np.ndarray, starts: np.ndarray, lengths: np.ndarray, width: int) -> np.ndarray:
+    ''' Gather the byte strings buf[start:start+length] into an S-dtype array in one pass
+    Blank (whitespace only) strings are returned as b''
+    '''
+    width = max(int(width), 1)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=f'S{width}')
+
+    offsets = np.arange(width)
+    idx = np.minimum(starts[:, None] + offsets, len(buf) - 1)
+    chars = np.where(offsets < lengths[:, None], buf[idx], 0).astype(np.uint8)
+    strings = chars.view(f'S{width}').ravel()
+    strings[~(~_SEPARATORS[chars] & (chars != 0)).any(axis=1)] = b''
+    return strings
+
+
+def decodeCards(data, widths: list[int], firstLineNum: int=0) -> tuple[list[np.ndarray], np.ndarray]:
+    ''' Decode a block of data cards (the lines between two keyword lines) in one pass
+
+    data: bytes-like object containing the block
+    widths: field lengths of the fixed-width format, e.g. [8, 16, 16, 16, 8, 8] for *NODE.
+            Lines made of a single token are sliced with these lengths; every other line is read as
+            free format (fields separated by commas or whitespace)
+    firstLineNum: line number of the first line of the block
+
+    Return (fields, lineNums)
+        fields: list of S-dtype arrays, one per field, with one entry per card (b'' if blank or missing)
+        lineNums: int64 array of the line number of each card
+    Comment and empty lines are skipped.
+    '''
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if len(buf) == 0:
+        return [np.zeros(0, dtype=f'S{w}') for w in widths], np.zeros(0, dtype=np.int64)
+
+    # Line boundaries (the last line might not end with a newline)
+    newlines = np.flatnonzero(buf == ord('\n'))
+    lineStarts = np.concatenate(([0], newlines + 1))
+    lineEnds = np.concatenate((newlines, [len(buf)]))
+    if lineStarts[-1] == len(buf):
+        lineStarts, lineEnds = lineStarts[:-1], lineEnds[:-1]
+    numLines = len(lineStarts)
+
+    # Token boundaries: a token is a run of non-separator bytes (same as re.findall(r'[^,\s]+', line))
+    notSep = ~_SEPARATORS[buf]
+    tokStarts = np.flatnonzero(notSep & np.concatenate(([True], ~notSep[:-1])))
+    tokEnds = np.flatnonzero(notSep & np.concatenate((~notSep[1:], [True]))) + 1
+    tokLine = np.searchsorted(lineStarts, tokStarts, side='right') - 1
+    numTokens = np.bincount(tokLine, minlength=numLines)
+    firstTok = np.searchsorted(tokLine, np.arange(numLines))
+
+    # Skip empty lines and comments
+    valid = numTokens > 0
+    valid[valid] = buf[tokStarts[firstTok[valid]]] != ord('$')
+    fixed = (numTokens == 1)[valid]
+    validLines = np.flatnonzero(valid)
+
+    # Fixed-width lines are sliced from the start of the line (excluding the line break)
+    fixedStarts = lineStarts[validLines[fixed]]
+    fixedEnds = tokEnds[firstTok[validLines[fixed]]]
+
+    # Free-format lines take their fields from the tokens in order
+    freeLines = validLines[~fixed]
+    freeTokens = [firstTok[freeLines] + i for i in range(len(widths))]
+    freeMissing = [numTokens[freeLines] <= i for i in range(len(widths))]
+
+    fields = []
+    offset = 0
+    for i, width in enumerate(widths):
+        fixedField = _gatherStrings(buf, fixedStarts + offset, fixedEnds - fixedStarts - offset, width)
+        offset += width
+
+        tokInd = np.where(freeMissing[i], 0, freeTokens[i])
+        tokLengths = np.where(freeMissing[i], 0, tokEnds[tokInd] - tokStarts[tokInd]) if len(tokStarts) else tokInd
+        freeField = _gatherStrings(buf, tokStarts[tokInd] if len(tokStarts) else tokInd, tokLengths, tokLengths.max(initial=1))
+
+        field = np.zeros(len(validLines), dtype=f'S{max(width, freeField.itemsize)}')
+        field[fixed] = fixedField
+        field[~fixed] = freeField
+        fields.append(field)
+
+    return fields, firstLineNum + validLines.astype(np.int64)
+
+
+def parseNumbers(field: np.ndarray, dtype=np.float64) -> tuple[np.ndarray, np.ndarray]:
+    ''' Convert a field returned by decodeCards into numbers. Blank entries are converted to 0
+
+    Return (values, bad): bad is True where the entry could not be converted
     '''
-    pattern = ''.join(f'(.{{{length}}})' if enforced else f'(.{{{length}}})?' for length, enforced in zip(groupLengths, enforcedGroups))
-    pattern = f'^{pattern}$'
-    match = re.match(pattern, s)
-
-    if match:
-        groups = match.groups()
-        return groups
-    else:
-        return None
\ No newline at end of file
+    filled = np.where(field == b'', b'0', field)
+    try:
+        return filled.astype(dtype), np.zeros(len(field), dtype=bool)
+    except ValueError:
+        # Fall back to converting one by one to find the bad entries
+        convert = int if np.issubdtype(dtype, np.integer) else float
+        values = np.zeros(len(field), dtype=dtype)
+        bad = np.zeros(len(field), dtype=bool)
+        for i, s in enumerate(filled):
+            try:
+                values[i] = convert(s)
+            except ValueError:
+                bad[i] = True
+        return values, bad